@@ -1,18 +1,29 @@
-import yaml
+import numpy as np
+import matplotlib.colors as mcolors
 import matplotlib.pylab as plt
+from stripeline.instrumentdb import load_yaml_cached
 
-with open('../instrument/strip_focal_plane.yaml', 'rt') as f:
-    focal_plane = yaml.load(f)
+focal_plane = load_yaml_cached('../instrument/strip_focal_plane.yaml')
 
-points = [(x['orientation'][0], x['orientation'][1], key, x['color'])
-          for key, x in focal_plane['horns'].items()]
-plt.scatter(x=[x[0] for x in points],
-            y=[x[1] for x in points],
-            color=[x[3] for x in points],
-            s=500, alpha=0.8)
+# Build the arrays needed by the plot in one pass over the horns
+horns = focal_plane['horns']
+xy = np.empty((len(horns), 2))
+colors = []
+labels = []
+for idx, (key, horn) in enumerate(horns.items()):
+    xy[idx] = horn['orientation'][:2]
+    colors.append(horn['color'])
+    labels.append(key)
 
-for pt in points:
-    plt.text(pt[0], pt[1], pt[2],
+# Passing an (N, 4) array of RGBA colors avoids converting each color while
+# drawing. The points are rasterized, so that the size of the SVG file does
+# not grow with the number of horns (they are not saved as separate paths)
+rgba = np.array([mcolors.to_rgba(x, alpha=0.8) for x in colors])
+points = plt.scatter(x=xy[:, 0], y=xy[:, 1], c=rgba, s=500)
+points.set_rasterized(True)
+
+for (x, y), label in zip(xy, labels):
+    plt.text(x, y, label,
              horizontalalignment='center',
              verticalalignment='center')
 
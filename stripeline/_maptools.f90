@@ -1,64 +1,469 @@
+! Helpers shared by the kernels in this file. They are not meant to be
+! called from Python: the "!f2py private" directive hides them from f2py,
+! while the compiler still sees them as public.
+!
+! When only one thread is available, the kernels producing I, Q, U maps
+! accumulate the samples directly in the output maps. Otherwise, each thread
+! accumulates samples in its own copy of the maps ("alloc_local_maps"), and
+! the copies are summed together at the end ("merge_local_maps"). This is
+! not worth doing with one thread, as it would double the memory traffic on
+! the maps.
+module maptools_helpers
+    !f2py private
+    implicit none
+
+contains
+
+    ! The copies are allocated on the heap, as they can easily exceed the
+    ! size of the stack of a thread
+    subroutine alloc_local_maps(npix, m_i, m_q, m_u, h)
+        integer(kind=8), intent(in) :: npix
+        real(kind=8), allocatable, intent(out) :: m_i(:), m_q(:), m_u(:)
+        integer(kind=8), allocatable, intent(out) :: h(:)
+
+        allocate(m_i(npix), m_q(npix), m_u(npix), h(npix))
+        m_i = 0.0
+        m_q = 0.0
+        m_u = 0.0
+        h = 0
+    end subroutine alloc_local_maps
+
+    ! Add the copy of the maps of the calling thread to the output maps, and
+    ! free it. This must be called within the parallel region
+    subroutine merge_local_maps(local_i, local_q, local_u, local_hits, &
+         map_i, map_q, map_u, hits)
+        real(kind=8), allocatable, intent(inout) :: local_i(:), local_q(:), local_u(:)
+        integer(kind=8), allocatable, intent(inout) :: local_hits(:)
+        real(kind=8), dimension(:), intent(inout) :: map_i, map_q, map_u
+        integer(kind=8), dimension(:), intent(inout) :: hits
+
+        !$omp critical
+        map_i = map_i + local_i
+        map_q = map_q + local_q
+        map_u = map_u + local_u
+        hits = hits + local_hits
+        !$omp end critical
+
+        deallocate(local_i, local_q, local_u, local_hits)
+    end subroutine merge_local_maps
+
+    ! Turn the sums accumulated in the maps into averages
+    subroutine normalize_maps(map_i, map_q, map_u, hits)
+        real(kind=8), dimension(:), intent(inout) :: map_i, map_q, map_u
+        integer(kind=8), dimension(:), intent(in) :: hits
+
+        integer(kind=8) :: i
+
+        !$omp parallel do schedule(static)
+        do i = 1, size(hits)
+            if (hits(i) .gt. 0) then
+                map_i(i) = map_i(i) / hits(i)
+                map_q(i) = map_q(i) / hits(i)
+                map_u(i) = map_u(i) / hits(i)
+            end if
+        end do
+        !$omp end parallel do
+    end subroutine normalize_maps
+
+    ! Zero-based index of the pixel containing the direction (theta, phi) in
+    ! RING ordering. This follows "loc2pix" in the Healpix C++ library (used
+    ! by healpy), so that the result is the same as healpy.ang2pix.
+    pure function ang2pix_ring(nside, theta, phi) result(pix)
+        integer(kind=8), intent(in) :: nside
+        real(kind=8), intent(in) :: theta
+        real(kind=8), intent(in) :: phi
+        integer(kind=8) :: pix
+
+        real(kind=8), parameter :: inv_halfpi = 0.6366197723675813430755350534900574d0
+        real(kind=8), parameter :: twothird = 2d0 / 3d0
+        real(kind=8) :: z, za, tt, tp, tmp, temp1, temp2
+        integer(kind=8) :: nl4, jp, jm, ir, ip, kshift, t1
+
+        z = cos(theta)
+        za = abs(z)
+
+        ! Longitude in units of pi/2, in the range [0, 4[
+        tt = phi * inv_halfpi
+        if (tt < 0) then
+            tt = mod(tt, 4d0) + 4
+            if (tt == 4) tt = 0
+        else if (tt >= 4) then
+            tt = mod(tt, 4d0)
+        end if
+
+        if (za <= twothird) then
+            ! Equatorial region
+            nl4 = 4 * nside
+            temp1 = nside * (0.5d0 + tt)
+            temp2 = nside * z * 0.75d0
+            jp = int(temp1 - temp2, kind=8)
+            jm = int(temp1 + temp2, kind=8)
+
+            ir = nside + 1 + jp - jm
+            kshift = 1 - iand(ir, 1_8)
+            t1 = jp + jm - nside + kshift + 1 + nl4 + nl4
+            ip = modulo(t1 / 2, nl4)
+
+            pix = 2 * nside * (nside - 1) + (ir - 1) * nl4 + ip
+        else
+            ! Polar caps. Near the poles, 1 - |z| loses precision, so the
+            ! sine of theta is used instead
+            tp = tt - int(tt, kind=8)
+            if (za < 0.99d0 .or. (theta >= 0.01d0 .and. theta <= 3.14159d0 - 0.01d0)) then
+                tmp = nside * sqrt(3 * (1 - za))
+            else
+                tmp = nside * sin(theta) / sqrt((1 + za) / 3)
+            end if
+
+            jp = int(tp * tmp, kind=8)
+            jm = int((1 - tp) * tmp, kind=8)
+            ir = jp + jm + 1
+            ip = int(tt * ir, kind=8)
+
+            if (z > 0) then
+                pix = 2 * ir * (ir - 1) + ip
+            else
+                pix = 12 * nside * nside - 2 * ir * (ir + 1) + ip
+            end if
+        end if
+    end function ang2pix_ring
+
+end module maptools_helpers
+
 ! Update the array of conditioning matrices "m" with new samples from
 ! a TOD. The "pixidx" array contains the zero-based indexes in the Healpix
 ! map of the polarization angles in the array "angle". Note that
 ! "pixidx" must be a *zero-based* array! The routine internally does the
 ! conversion to Fortran indexing (which is 1-based).
-subroutine update_condmatr(numpix, pixidx, angle, m)
+!
+! The nine elements of the matrix of each pixel are contiguous in memory,
+! i.e., "m" is the transpose of a C-ordered (numpix, 3, 3) NumPy array.
+! The loop is parallelized using OpenMP, like the one in "binned_map".
+!
+! The routines in this file release the GIL (see the "threadsafe" directives
+! below), so they can be called by several Python threads at the same time,
+! as long as each thread uses its own output arrays. Arrays are declared
+! with explicit shapes, as f2py would otherwise generate a Fortran wrapper
+! that does not support "threadsafe"; the trailing size arguments are
+! optional in Python and inferred from the arrays.
+subroutine update_condmatr(numpix, pixidx, angle, m, nsamples)
+    !f2py threadsafe
+    !$ use omp_lib
     implicit none
 
     integer(kind=8), intent(in) :: numpix
-    integer(kind=4), dimension(:), intent(in) :: pixidx
-    real(kind=8), dimension(size(pixidx)), intent(in) :: angle
-    real(kind=8), dimension(numpix, 9), intent(inout) :: m
+    integer(kind=8), intent(in) :: nsamples
+    integer(kind=4), dimension(nsamples), intent(in) :: pixidx
+    real(kind=8), dimension(nsamples), intent(in) :: angle
+    real(kind=8), dimension(9, numpix), intent(inout) :: m
 
-    real(kind=8) :: cos2angle
-    real(kind=8) :: sin2angle
-    real(kind=8) :: sincos2angle
-    integer :: i
-    integer(kind=4) :: pixidx1
+    real(kind=8), allocatable :: local_m(:, :)
+    integer(kind=8) :: i
+    integer :: num_of_threads
 
-    do i = 1, size(pixidx)
-        ! Python indexing to Fortran indexing
-        pixidx1 = pixidx(i) + 1
+    num_of_threads = 1
+    !$ num_of_threads = omp_get_max_threads()
+
+    if (num_of_threads == 1) then
+        do i = 1, size(pixidx)
+            ! Python indexing to Fortran indexing
+            call add_sample(m(:, pixidx(i) + 1), angle(i))
+        end do
+    else
+        ! As in "binned_map", each thread accumulates samples in its own
+        ! copy of the matrices, and the copies are summed at the end. This is
+        ! not worth doing with one thread, as it would double the memory
+        ! traffic on "m"
+        !$omp parallel private(local_m)
+        allocate(local_m(9, numpix))
+        local_m = 0.0
+
+        !$omp do schedule(static)
+        do i = 1, size(pixidx)
+            call add_sample(local_m(:, pixidx(i) + 1), angle(i))
+        end do
+        !$omp end do nowait
+
+        !$omp critical
+        m = m + local_m
+        !$omp end critical
+
+        deallocate(local_m)
+        !$omp end parallel
+    end if
+
+contains
+
+    pure subroutine add_sample(mat, angle)
+        real(kind=8), dimension(9), intent(inout) :: mat
+        real(kind=8), intent(in) :: angle
 
-        cos2angle = cos(2.0 * angle(i))
-        sin2angle = sin(2.0 * angle(i))
+        real(kind=8) :: cos2angle
+        real(kind=8) :: sin2angle
+        real(kind=8) :: sincos2angle
+
+        cos2angle = cos(2.0 * angle)
+        sin2angle = sin(2.0 * angle)
         sincos2angle = sin2angle * cos2angle
 
-        m(pixidx1, 1) = m(pixidx1, 1) + 1
-        m(pixidx1, 2) = m(pixidx1, 2) + cos2angle 
-        m(pixidx1, 3) = m(pixidx1, 3) + sin2angle 
-        m(pixidx1, 4) = m(pixidx1, 4) + cos2angle 
-        m(pixidx1, 5) = m(pixidx1, 5) + cos2angle * cos2angle 
-        m(pixidx1, 6) = m(pixidx1, 6) + sincos2angle 
-        m(pixidx1, 7) = m(pixidx1, 7) + sin2angle 
-        m(pixidx1, 8) = m(pixidx1, 8) + sincos2angle 
-        m(pixidx1, 9) = m(pixidx1, 9) + sin2angle * sin2angle 
-    end do
+        mat(1) = mat(1) + 1
+        mat(2) = mat(2) + cos2angle
+        mat(3) = mat(3) + sin2angle
+        mat(4) = mat(4) + cos2angle
+        mat(5) = mat(5) + cos2angle * cos2angle
+        mat(6) = mat(6) + sincos2angle
+        mat(7) = mat(7) + sin2angle
+        mat(8) = mat(8) + sincos2angle
+        mat(9) = mat(9) + sin2angle * sin2angle
+    end subroutine add_sample
+
 end subroutine update_condmatr
 
-subroutine binned_map(signal, pixidx, mappixels, hits)
+! Bin the samples in "signal" into the map "mappixels", counting how many
+! samples fall in each pixel in "hits". The loop is parallelized using
+! OpenMP: the number of threads can be set using OMP_NUM_THREADS.
+subroutine binned_map(signal, pixidx, mappixels, hits, nsamples, npix)
+    !f2py threadsafe
+    !$ use omp_lib
     implicit none
 
-    real(kind=8), dimension(:), intent(in) :: signal
-    integer(kind=8), dimension(size(signal)), intent(in) :: pixidx
-    real(kind=8), dimension(:), intent(inout) :: mappixels
-    integer(kind=8), dimension(size(mappixels)), intent(inout) :: hits
+    integer(kind=8), intent(in) :: nsamples
+    integer(kind=8), intent(in) :: npix
+    real(kind=8), dimension(nsamples), intent(in) :: signal
+    integer(kind=8), dimension(nsamples), intent(in) :: pixidx
+    real(kind=8), dimension(npix), intent(inout) :: mappixels
+    integer(kind=8), dimension(npix), intent(inout) :: hits
 
-    integer :: i
+    include '_binned_map.inc'
 
-    mappixels = 0.0
-    hits = 0
+end subroutine binned_map
 
-    do i = 1, size(signal)
-        mappixels(pixidx(i) + 1) = mappixels(pixidx(i) + 1) + signal(i)
-        hits(pixidx(i) + 1) = hits(pixidx(i) + 1) + 1
-    end do
+! Same as "binned_map", but using 32-bit integers for the pixel indexes and
+! the hit map. This is enough for Healpix maps with NSIDE up to 8192, and it
+! halves the amount of memory read and written by the loop.
+subroutine binned_map_i32(signal, pixidx, mappixels, hits, nsamples, npix)
+    !f2py threadsafe
+    !$ use omp_lib
+    implicit none
 
-    do i = 1, size(mappixels)
-        if (hits(i) .gt. 0) then
-            mappixels(i) = mappixels(i) / hits(i)
-        end if
+    integer(kind=8), intent(in) :: nsamples
+    integer(kind=8), intent(in) :: npix
+    real(kind=8), dimension(nsamples), intent(in) :: signal
+    integer(kind=4), dimension(nsamples), intent(in) :: pixidx
+    real(kind=8), dimension(npix), intent(inout) :: mappixels
+    integer(kind=4), dimension(npix), intent(inout) :: hits
+
+    include '_binned_map.inc'
+
+end subroutine binned_map_i32
+
+! Produce the I, Q, U maps of a STRIP polarimeter in one pass over the TOD.
+! This is the same as combining the outputs Q1, Q2, U1, and U2 of the
+! detector (see "observe_sky"), rotating Q and U by "psi" into the celestial
+! reference frame (see polarization.rotate_qu, with inverse=True), and
+! calling "binned_map" three times, but no temporary array is created and
+! the TOD is read only once. The loop is parallelized using OpenMP, like the
+! one in "update_condmatr".
+subroutine binned_map_iqu(q1, q2, u1, u2, psi, pixidx, map_i, map_q, map_u, &
+     hits, nsamples, npix)
+    !f2py threadsafe
+    use maptools_helpers
+    !$ use omp_lib
+    implicit none
+
+    integer(kind=8), intent(in) :: nsamples
+    integer(kind=8), intent(in) :: npix
+    real(kind=8), dimension(nsamples), intent(in) :: q1
+    real(kind=8), dimension(nsamples), intent(in) :: q2
+    real(kind=8), dimension(nsamples), intent(in) :: u1
+    real(kind=8), dimension(nsamples), intent(in) :: u2
+    real(kind=8), dimension(nsamples), intent(in) :: psi
+    integer(kind=8), dimension(nsamples), intent(in) :: pixidx
+    real(kind=8), dimension(npix), intent(inout) :: map_i
+    real(kind=8), dimension(npix), intent(inout) :: map_q
+    real(kind=8), dimension(npix), intent(inout) :: map_u
+    integer(kind=8), dimension(npix), intent(inout) :: hits
+
+    include '_binned_map_iqu.inc'
+
+end subroutine binned_map_iqu
+
+! Same as "binned_map_iqu", but using 32-bit integers for the pixel indexes,
+! like the ones returned by ToiProvider.get_pixel_index (see "binned_map_i32").
+! The hit map still uses 64-bit integers, as in "binned_map_iqu".
+subroutine binned_map_iqu_i32(q1, q2, u1, u2, psi, pixidx, map_i, map_q, map_u, &
+     hits, nsamples, npix)
+    !f2py threadsafe
+    use maptools_helpers
+    !$ use omp_lib
+    implicit none
+
+    integer(kind=8), intent(in) :: nsamples
+    integer(kind=8), intent(in) :: npix
+    real(kind=8), dimension(nsamples), intent(in) :: q1
+    real(kind=8), dimension(nsamples), intent(in) :: q2
+    real(kind=8), dimension(nsamples), intent(in) :: u1
+    real(kind=8), dimension(nsamples), intent(in) :: u2
+    real(kind=8), dimension(nsamples), intent(in) :: psi
+    integer(kind=4), dimension(nsamples), intent(in) :: pixidx
+    real(kind=8), dimension(npix), intent(inout) :: map_i
+    real(kind=8), dimension(npix), intent(inout) :: map_q
+    real(kind=8), dimension(npix), intent(inout) :: map_u
+    integer(kind=8), dimension(npix), intent(inout) :: hits
+
+    include '_binned_map_iqu.inc'
+
+end subroutine binned_map_iqu_i32
+
+! Produce the I, Q, U maps from the outputs Q1, Q2, U1, and U2 of a STRIP
+! polarimeter, assuming that they are (I + Q) / 4, (I - Q) / 4, (I + U) / 4,
+! and (I - U) / 4 (see "observe_sky") and that Q and U are already measured
+! in the celestial reference frame. Like "binned_map_iqu", the TOD is read
+! only once, and the loop is parallelized using OpenMP.
+subroutine binned_map_detectors(q1, q2, u1, u2, pixidx, map_i, map_q, map_u, &
+     hits, nsamples, npix)
+    !f2py threadsafe
+    use maptools_helpers
+    !$ use omp_lib
+    implicit none
+
+    integer(kind=8), intent(in) :: nsamples
+    integer(kind=8), intent(in) :: npix
+    real(kind=8), dimension(nsamples), intent(in) :: q1
+    real(kind=8), dimension(nsamples), intent(in) :: q2
+    real(kind=8), dimension(nsamples), intent(in) :: u1
+    real(kind=8), dimension(nsamples), intent(in) :: u2
+    integer(kind=8), dimension(nsamples), intent(in) :: pixidx
+    real(kind=8), dimension(npix), intent(inout) :: map_i
+    real(kind=8), dimension(npix), intent(inout) :: map_q
+    real(kind=8), dimension(npix), intent(inout) :: map_u
+    integer(kind=8), dimension(npix), intent(inout) :: hits
+
+    include '_binned_map_detectors.inc'
+
+    pure function sample_pixel(i)
+        integer(kind=8), intent(in) :: i
+        integer(kind=8) :: sample_pixel
+
+        sample_pixel = pixidx(i)
+    end function sample_pixel
+
+end subroutine binned_map_detectors
+
+! Same as "binned_map_detectors", but using 32-bit integers for the pixel
+! indexes (see "binned_map_iqu_i32").
+subroutine binned_map_detectors_i32(q1, q2, u1, u2, pixidx, map_i, map_q, map_u, &
+     hits, nsamples, npix)
+    !f2py threadsafe
+    use maptools_helpers
+    !$ use omp_lib
+    implicit none
+
+    integer(kind=8), intent(in) :: nsamples
+    integer(kind=8), intent(in) :: npix
+    real(kind=8), dimension(nsamples), intent(in) :: q1
+    real(kind=8), dimension(nsamples), intent(in) :: q2
+    real(kind=8), dimension(nsamples), intent(in) :: u1
+    real(kind=8), dimension(nsamples), intent(in) :: u2
+    integer(kind=4), dimension(nsamples), intent(in) :: pixidx
+    real(kind=8), dimension(npix), intent(inout) :: map_i
+    real(kind=8), dimension(npix), intent(inout) :: map_q
+    real(kind=8), dimension(npix), intent(inout) :: map_u
+    integer(kind=8), dimension(npix), intent(inout) :: hits
+
+    include '_binned_map_detectors.inc'
+
+    pure function sample_pixel(i)
+        integer(kind=8), intent(in) :: i
+        integer(kind=8) :: sample_pixel
+
+        sample_pixel = pixidx(i)
+    end function sample_pixel
+
+end subroutine binned_map_detectors_i32
+
+! Same as "binned_map_detectors", but the pixel indexes are computed from the
+! directions "theta", "phi" (colatitude and longitude) in each sample, using
+! a Healpix map with resolution "nside" in RING ordering. This avoids
+! creating the array of pixel indexes and reading it again.
+subroutine binned_map_detectors_ang(nside, theta, phi, q1, q2, u1, u2, &
+     map_i, map_q, map_u, hits, nsamples, npix)
+    !f2py threadsafe
+    use maptools_helpers
+    !$ use omp_lib
+    implicit none
+
+    integer(kind=8), intent(in) :: nside
+    integer(kind=8), intent(in) :: nsamples
+    integer(kind=8), intent(in) :: npix
+    real(kind=8), dimension(nsamples), intent(in) :: theta
+    real(kind=8), dimension(nsamples), intent(in) :: phi
+    real(kind=8), dimension(nsamples), intent(in) :: q1
+    real(kind=8), dimension(nsamples), intent(in) :: q2
+    real(kind=8), dimension(nsamples), intent(in) :: u1
+    real(kind=8), dimension(nsamples), intent(in) :: u2
+    real(kind=8), dimension(npix), intent(inout) :: map_i
+    real(kind=8), dimension(npix), intent(inout) :: map_q
+    real(kind=8), dimension(npix), intent(inout) :: map_u
+    integer(kind=8), dimension(npix), intent(inout) :: hits
+
+    include '_binned_map_detectors.inc'
+
+    pure function sample_pixel(i)
+        integer(kind=8), intent(in) :: i
+        integer(kind=8) :: sample_pixel
+
+        sample_pixel = ang2pix_ring(nside, theta(i), phi(i))
+    end function sample_pixel
+
+end subroutine binned_map_detectors_ang
+
+! Simulate what a STRIP polarimeter measures when observing the I/Q/U maps
+! "map_i", "map_q", and "map_u" (in Healpix RING ordering, with resolution
+! "nside") along the directions "theta", "phi" (colatitude and longitude) with
+! polarization angles "psi". This is the same as calling healpy.ang2pix,
+! picking the Stokes parameters of each pixel, rotating Q and U by -psi (see
+! polarization.rotate_qu), and combining them in the four outputs of the
+! detector, but everything is done in one loop, without temporary arrays.
+!
+! The columns of "det" contain the outputs Q1, Q2, U1, and U2, i.e.,
+! (I + Q) / 4, (I - Q) / 4, (I + U) / 4, and (I - U) / 4.
+subroutine observe_sky(nside, theta, phi, psi, map_i, map_q, map_u, det, &
+     nsamples, npix)
+    !f2py threadsafe
+    use maptools_helpers
+    implicit none
+
+    integer(kind=8), intent(in) :: nside
+    integer(kind=8), intent(in) :: nsamples
+    integer(kind=8), intent(in) :: npix
+    real(kind=8), dimension(nsamples), intent(in) :: theta
+    real(kind=8), dimension(nsamples), intent(in) :: phi
+    real(kind=8), dimension(nsamples), intent(in) :: psi
+    real(kind=8), dimension(npix), intent(in) :: map_i
+    real(kind=8), dimension(npix), intent(in) :: map_q
+    real(kind=8), dimension(npix), intent(in) :: map_u
+    real(kind=8), dimension(nsamples, 4), intent(out) :: det
+
+    real(kind=8) :: cos2psi, sin2psi, q_beam, u_beam
+    integer(kind=8) :: i, pix1
+
+    !$omp parallel do schedule(static) &
+    !$omp private(cos2psi, sin2psi, q_beam, u_beam, pix1)
+    do i = 1, nsamples
+        ! Python indexing to Fortran indexing
+        pix1 = ang2pix_ring(nside, theta(i), phi(i)) + 1
+
+        cos2psi = cos(2 * psi(i))
+        sin2psi = sin(2 * psi(i))
+        q_beam = cos2psi * map_q(pix1) - sin2psi * map_u(pix1)
+        u_beam = cos2psi * map_u(pix1) + sin2psi * map_q(pix1)
+
+        det(i, 1) = (map_i(pix1) + q_beam) * 0.25d0
+        det(i, 2) = (map_i(pix1) - q_beam) * 0.25d0
+        det(i, 3) = (map_i(pix1) + u_beam) * 0.25d0
+        det(i, 4) = (map_i(pix1) - u_beam) * 0.25d0
     end do
+    !$omp end parallel do
 
-end subroutine binned_map
\ No newline at end of file
+end subroutine observe_sky
@@ -0,0 +1,215 @@
+! Fused computation of the pointings produced by "generate_pointings" (see
+! scanning.py). Instead of building arrays of quaternions for each step of
+! the computation, each sample is processed on its own using scalar
+! variables, so that no temporary array is ever created.
+!
+! Quaternions are represented as in _quaternions.f90, i.e., the scalar is
+! the last coefficient in the 4-element array.
+!
+! The result is a (nsamples, 4) matrix whose columns contain the time,
+! colatitude, longitude, and polarization angle of each sample. As the
+! matrix is in Fortran order, each column is contiguous in memory.
+!
+! The routine releases the GIL, so that several chunks can be computed at
+! the same time by different Python threads. If the module has been compiled
+! with OpenMP, the blocks of samples in one chunk are split among threads
+! too (use OMP_NUM_THREADS to avoid oversubscribing the CPUs when both
+! mechanisms are used).
+
+subroutine compute_pointings(start_time, sampling_frequency, dir_vec, &
+     wheel1_omega, wheel3_omega, wheel1_angle0, wheel2_angle0, wheel3_angle0, &
+     colatitude, pointings, nsamples)
+  !f2py threadsafe
+  implicit none
+
+  integer(kind=8), intent(in) :: nsamples
+  real(kind=8), intent(in) :: start_time
+  real(kind=8), intent(in) :: sampling_frequency
+  real(kind=8), dimension(3), intent(in) :: dir_vec
+  ! Angular velocities of the wheels, in radians per second
+  real(kind=8), intent(in) :: wheel1_omega
+  real(kind=8), intent(in) :: wheel3_omega
+  ! The angles are expressed in radians
+  real(kind=8), intent(in) :: wheel1_angle0
+  real(kind=8), intent(in) :: wheel2_angle0
+  real(kind=8), intent(in) :: wheel3_angle0
+  real(kind=8), intent(in) :: colatitude
+  real(kind=8), dimension(nsamples, 4), intent(out) :: pointings
+
+  real(kind=8), parameter :: pi = 3.14159265358979323846264338327950288d0
+  ! Angular velocity of the Earth's rotation [rad/s]
+  real(kind=8), parameter :: earth_omega = 2 * pi / 86400
+  real(kind=8), dimension(3), parameter :: x_vec = (/ 1d0, 0d0, 0d0 /)
+  real(kind=8), dimension(3), parameter :: z_vec = (/ 0d0, 0d0, 1d0 /)
+
+  ! Number of samples between two exact evaluations of the rotation angles
+  integer(kind=8), parameter :: block_size = 1024
+
+  real(kind=8), dimension(4) :: qwheel1, qwheel2, qwheel3
+  real(kind=8), dimension(4) :: location_quat, earth_rot_quat, quat
+  real(kind=8), dimension(3) :: dir, poldir, northdir
+  ! Cosine and sine of half the rotation angles of wheels 1 and 3 and of
+  ! the Earth, and of the half-angles they advance by at each sample
+  real(kind=8), dimension(2) :: cs1, cs3, cse, step1, step3, stepe
+  real(kind=8) :: time, theta, phi, psi
+  real(kind=8) :: dnorm, rho, cos_phi, sin_phi
+  real(kind=8) :: cos_psi, sin_psi
+  integer(kind=8) :: i, block_start
+
+  ! These rotations do not depend on time
+  qwheel2 = qfromaxisangle(x_vec, wheel2_angle0)
+  location_quat = qfromaxisangle(x_vec, colatitude)
+
+  step1 = cossin(wheel1_omega / sampling_frequency / 2)
+  step3 = cossin(wheel3_omega / sampling_frequency / 2)
+  stepe = cossin(earth_omega / sampling_frequency / 2)
+
+  !$omp parallel do schedule(static) &
+  !$omp private(qwheel1, qwheel3, earth_rot_quat, quat, dir, poldir, &
+  !$omp         northdir, cs1, cs3, cse, time, theta, phi, psi, &
+  !$omp         dnorm, rho, cos_phi, sin_phi, cos_psi, sin_psi, i)
+  do block_start = 1, nsamples, block_size
+     ! The angles grow linearly with time, so within a block their sines
+     ! and cosines are computed using the angle addition formulae instead
+     ! of calling trigonometric functions. At the beginning of each block
+     ! they are computed exactly, to avoid accumulating rounding errors
+     time = start_time + (block_start - 1) / sampling_frequency
+     cs1 = cossin((wheel1_angle0 + wheel1_omega * time) / 2)
+     cs3 = cossin((wheel3_angle0 + wheel3_omega * time) / 2)
+     cse = cossin(earth_omega * time / 2)
+
+     do i = block_start, min(block_start + block_size - 1, nsamples)
+        if (i > block_start) then
+           cs1 = rotate_cossin(cs1, step1)
+           cs3 = rotate_cossin(cs3, step3)
+           cse = rotate_cossin(cse, stepe)
+        end if
+
+        ! Same as "start_time + np.arange(nsamples) / sampling_frequency"
+        time = start_time + (i - 1) / sampling_frequency
+
+        qwheel1(1:3) = cs1(2) * dir_vec
+        qwheel1(4) = cs1(1)
+        qwheel3 = (/ 0d0, 0d0, cs3(2), cs3(1) /)
+        earth_rot_quat = (/ 0d0, 0d0, cse(2), cse(1) /)
+
+        ! Ground reference frame first, then the Earth's centre
+        quat = qmul(qwheel3, qmul(qwheel2, qwheel1))
+        quat = qmul(earth_rot_quat, qmul(location_quat, quat))
+
+        dir = qrotate(dir_vec, quat)
+        poldir = qrotate(x_vec, quat)
+
+        ! Same as healpy.vec2ang
+        dnorm = sqrt(dir(1) * dir(1) + dir(2) * dir(2) + dir(3) * dir(3))
+        theta = acos(dir(3) / dnorm)
+        phi = atan2(dir(2), dir(1))
+        if (phi < 0) phi = phi + 2 * pi
+
+        ! The north direction for a vector v is just -dv/dtheta, as theta is
+        ! the colatitude and moves along the meridian. The sines and cosines
+        ! of theta and phi are derived from the components of "dir", instead
+        ! of calling trigonometric functions. At the poles, phi is zero (this
+        ! is what atan2 returns)
+        rho = sqrt(dir(1) * dir(1) + dir(2) * dir(2))
+        if (rho > 0) then
+           cos_phi = dir(1) / rho
+           sin_phi = dir(2) / rho
+        else
+           cos_phi = 1
+           sin_phi = 0
+        end if
+        northdir(1) = -(dir(3) / dnorm) * cos_phi
+        northdir(2) = -(dir(3) / dnorm) * sin_phi
+        northdir(3) = rho / dnorm
+
+        ! The polarization angle is the angle between the north direction
+        ! and the projection of "poldir" on the plane tangent to the sky in
+        ! "dir", whose axes are the north direction and -phi_hat = (sin
+        ! phi, -cos phi, 0). It is positive when (north x poldir) points
+        ! along "dir". Using atan2 on the two projections gives the same
+        ! accuracy at all angles
+        cos_psi = northdir(1) * poldir(1) + northdir(2) * poldir(2) &
+             + northdir(3) * poldir(3)
+        sin_psi = poldir(1) * sin_phi - poldir(2) * cos_phi
+        psi = atan2(sin_psi, cos_psi)
+
+        pointings(i, 1) = time
+        pointings(i, 2) = theta
+        pointings(i, 3) = phi
+        pointings(i, 4) = psi
+     end do
+  end do
+  !$omp end parallel do
+
+contains
+
+  ! These functions work like their counterparts in _quaternions.f90, but
+  ! on one quaternion at a time
+
+  pure function cossin(angle) result(cs)
+    real(kind=8), intent(in) :: angle
+    real(kind=8), dimension(2) :: cs
+
+    cs(1) = cos(angle)
+    cs(2) = sin(angle)
+  end function cossin
+
+  ! Return the cosine and sine of a+b, given those of a and b
+  pure function rotate_cossin(cs, step) result(r)
+    real(kind=8), dimension(2), intent(in) :: cs
+    real(kind=8), dimension(2), intent(in) :: step
+    real(kind=8), dimension(2) :: r
+
+    r(1) = cs(1) * step(1) - cs(2) * step(2)
+    r(2) = cs(2) * step(1) + cs(1) * step(2)
+  end function rotate_cossin
+
+  pure function qfromaxisangle(axis, angle) result(q)
+    real(kind=8), dimension(3), intent(in) :: axis
+    real(kind=8), intent(in) :: angle
+    real(kind=8), dimension(4) :: q
+
+    q(1:3) = sin(angle / 2) * axis
+    q(4) = cos(angle / 2)
+  end function qfromaxisangle
+
+  pure function qmul(a, b) result(c)
+    real(kind=8), dimension(4), intent(in) :: a
+    real(kind=8), dimension(4), intent(in) :: b
+    real(kind=8), dimension(4) :: c
+
+    c(1) = a(1) * b(4) + a(4) * b(1) + a(2) * b(3) - a(3) * b(2)
+    c(2) = a(2) * b(4) + a(4) * b(2) + a(3) * b(1) - a(1) * b(3)
+    c(3) = a(3) * b(4) + a(4) * b(3) + a(1) * b(2) - a(2) * b(1)
+    c(4) = a(4) * b(4) - a(1) * b(1) - a(2) * b(2) - a(3) * b(3)
+  end function qmul
+
+  ! Compute q * vec * q^* using the Euler-Rodrigues formula
+  !
+  !     t = 2 (q_v x vec),  r = |q|^2 vec + q_w t + q_v x t
+  !
+  ! which needs about half the multiplications of two Hamilton products.
+  ! The factor |q|^2 keeps the result identical to qrotate in
+  ! _quaternions.f90 even when "q" is not normalized (this happens if
+  ! "dir_vec" is not a unit vector)
+  pure function qrotate(vec, q) result(r)
+    real(kind=8), dimension(3), intent(in) :: vec
+    real(kind=8), dimension(4), intent(in) :: q
+    real(kind=8), dimension(3) :: r
+
+    real(kind=8), dimension(3) :: t
+    real(kind=8) :: norm2
+
+    norm2 = q(1) * q(1) + q(2) * q(2) + q(3) * q(3) + q(4) * q(4)
+
+    t(1) = 2 * (q(2) * vec(3) - q(3) * vec(2))
+    t(2) = 2 * (q(3) * vec(1) - q(1) * vec(3))
+    t(3) = 2 * (q(1) * vec(2) - q(2) * vec(1))
+
+    r(1) = norm2 * vec(1) + q(4) * t(1) + q(2) * t(3) - q(3) * t(2)
+    r(2) = norm2 * vec(2) + q(4) * t(2) + q(3) * t(1) - q(1) * t(3)
+    r(3) = norm2 * vec(3) + q(4) * t(3) + q(1) * t(2) - q(2) * t(1)
+  end function qrotate
+
+end subroutine compute_pointings
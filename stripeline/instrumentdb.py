@@ -3,9 +3,21 @@
 
 'Utilities to access the instrument database.'
 
+from functools import lru_cache
+import hashlib
+import os
 import os.path
+import pickle
+import tempfile
+from typing import Any
 
+import yaml
 
+# Use the libyaml-based loader if PyYAML has been compiled with it
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+@lru_cache(maxsize=1)
 def instrument_db_path():
     '''Return the path to the instrument database.
 
@@ -15,17 +27,74 @@ def instrument_db_path():
     return os.path.abspath(os.path.join(os.path.dirname(__file__),
                                         '..', 'instrument'))
 
+@lru_cache(maxsize=1)
 def focal_plane_db_file_name():
     'Return the name of the file containing the definition of the focal plane.'
 
     return os.path.join(instrument_db_path(), 'strip_focal_plane.yaml')
 
+@lru_cache(maxsize=1)
 def detector_db_file_name():
     'Return the name of the file containing the definition of the detectors.'
 
     return os.path.join(instrument_db_path(), 'strip_detectors.yaml')
 
+@lru_cache(maxsize=1)
 def scanning_strategy_db_file_name():
     'Return the name of the file containing the definition of the scanning strategy.'
 
     return os.path.join(instrument_db_path(), 'scanning_strategy.yaml')
+
+
+def yaml_cache_path():
+    '''Return the path to the folder containing cached YAML files.
+
+    This is ``$XDG_CACHE_HOME/stripeline``, or ``~/.cache/stripeline`` if
+    the environment variable is not set.'''
+
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'stripeline')
+
+
+def load_yaml_cached(path: str) -> Any:
+    '''Load a YAML file, keeping a pickled copy of its contents.
+
+    The first time a file is loaded, the parsed object is saved in the folder
+    returned by :func:`yaml_cache_path`. Subsequent calls read the pickled
+    copy, which is much faster than parsing the YAML file again, until the
+    modification time or the size of the file change. If the cache cannot be
+    written, the file is just parsed every time.'''
+
+    path = os.path.abspath(path)
+    file_stat = os.stat(path)
+    key = '{0}:{1}:{2}'.format(path, file_stat.st_mtime_ns, file_stat.st_size)
+    cache_dir = yaml_cache_path()
+    cache_file = os.path.join(cache_dir,
+                              hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    with open(path, 'rt') as f:
+        result = yaml.load(f, Loader=_YamlLoader)
+
+    # Write the cache into a temporary file and then rename it, so that
+    # other processes never read a partially-written file
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_file_name = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file_name, cache_file)
+        except Exception:
+            os.remove(tmp_file_name)
+            raise
+    except OSError:
+        pass
+
+    return result
@@ -8,7 +8,6 @@ from typing import Any
 
 import stripeline._maptools as _m
 import stripeline.timetools as tt
-import stripeline.polarization as pol
 import numpy as np
 import healpy
 
@@ -43,18 +42,27 @@ class ConditionMatrix:
         to healpy.nside2npix.
         '''
         self.numpix = numpix
-        self.matr = np.zeros((numpix, 9), dtype='float64', order='F')
+        # Each 3×3 matrix occupies a contiguous block of memory
+        self.matr = np.zeros((numpix, 3, 3), dtype='float64', order='C')
 
     def update(self, pixidx: Any, angle: Any):
         '''Update the condition matrix with new samples from a TOD.
 
         The arrays `pixidx` and `angle` must have the same number of elements.
         The first array associates each item in `angle` with a pixel in the sky.
+        The Fortran routine uses 32-bit pixel indexes, like the ones returned
+        by :func:`stripeline.timetools.ToiProvider.get_pixel_index`: other
+        integer types are converted, which requires a temporary copy of
+        `pixidx`.
+
+        The computation releases the GIL, so different ConditionMatrix objects
+        can be updated by concurrent threads; the same object must not be
+        updated by more than one thread at a time.
         '''
-        print('pixidx.shape =', pixidx.shape)
-        print('matr.shape =', self.matr.shape)
+        # The Fortran routine wants a (9, numpix) array: this is a view of
+        # self.matr, so no copy is made
         _m.update_condmatr(numpix=self.numpix, pixidx=pixidx,
-                           angle=angle, m=self.matr)
+                           angle=angle, m=self.matr.reshape(self.numpix, 9).T)
 
     def to_map(self):
         '''Compute the inverse condition numbers and return them as a map.
@@ -63,15 +71,19 @@ class ConditionMatrix:
         (hit count is zero), or if the components I/Q/U cannot be determined
         at all.
         '''
-        seen_mask = self.matr[:, 0] > 0
+        seen_mask = self.matr[:, 0, 0] > 0
         cond_map = np.zeros(self.numpix)
 
-        # Ordered list of all the pixels which have an hit count larger than 0
-        pixels = np.arange(self.matr.shape[0])[seen_mask]
-
-        for cur_pixel in pixels:
-            cond_map[cur_pixel] = 1.0 / \
-                np.linalg.cond(np.reshape(self.matr[cur_pixel], (3, 3)))
+        # Stack the 3×3 matrices of all the pixels which have an hit count
+        # larger than 0, so that LAPACK is invoked only once. The inverse
+        # condition number is the ratio between the smallest and the largest
+        # singular value (they are sorted in descending order)
+        mats = self.matr[seen_mask]
+        sing_values = np.linalg.svd(mats, compute_uv=False)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cond_map[seen_mask] = np.where(sing_values[:, 0] > 0,
+                                           sing_values[:, -1] / sing_values[:, 0],
+                                           0.0)
 
         return cond_map
 
@@ -94,13 +106,17 @@ def nonoise_map(signal, pixidx, num_of_pixels):
     assert num_of_pixels > 0
 
     mappixels = np.zeros(num_of_pixels)
-    observed = np.zeros(num_of_pixels, dtype='bool')
 
-    for idx, cur_signal in enumerate(signal):
-        cur_pixidx = pixidx[idx]
-        if not observed[cur_pixidx]:
-            mappixels[cur_pixidx] = cur_signal
-            observed[cur_pixidx] = True
+    # Sorting 32-bit integers requires half the memory bandwidth of 64-bit
+    # integers, so shrink the indexes whenever they fit
+    pixidx = np.asarray(pixidx)
+    if pixidx.itemsize > 4 and num_of_pixels <= np.iinfo(np.int32).max:
+        pixidx = pixidx.astype('int32')
+
+    # "np.unique" returns the index of the *first* occurrence of each pixel,
+    # which is the sample we want to keep
+    observed_pixels, first_idx = np.unique(pixidx, return_index=True)
+    mappixels[observed_pixels] = np.asarray(signal)[first_idx]
 
     return mappixels
 
@@ -119,6 +135,9 @@ def binned_map(signal, pixidx, num_of_pixels):
     uncorrelated noise with zero mean and symmetric probability function.
 
     This function returns a tuple containing the binned map and the hit map.
+    If ``pixidx`` is an array of 32-bit integers (which is enough for Healpix
+    maps with NSIDE up to 8192), the hit map uses 32-bit integers as well and
+    a faster code path is used.
 
     The following example loads the pointing information and the signal TOD
     from a FITS file, creates a map and saves it to disk::
@@ -144,14 +163,124 @@ def binned_map(signal, pixidx, num_of_pixels):
     assert isinstance(num_of_pixels, int)
     assert num_of_pixels > 0
 
+    pixidx = np.asarray(pixidx)
     mappixels = np.zeros(num_of_pixels)
-    hits = np.zeros(num_of_pixels, dtype='int')
 
-    _m.binned_map(signal, pixidx, mappixels, hits)
+    if pixidx.dtype == np.int32:
+        hits = np.zeros(num_of_pixels, dtype='int32')
+        _m.binned_map_i32(signal, pixidx, mappixels, hits)
+    else:
+        hits = np.zeros(num_of_pixels, dtype='int64')
+        _m.binned_map(signal, pixidx, mappixels, hits)
 
     return mappixels, hits
 
 
+def binned_map_detectors(det_q1, det_q2, det_u1, det_u2, pixidx, num_of_pixels):
+    '''Produce I, Q, U maps from the outputs of a STRIP polarimeter.
+
+    The four timelines ``det_q1``, ``det_q2``, ``det_u1``, and ``det_u2``
+    contain the outputs of the detector, i.e., (I + Q)/4, (I - Q)/4, (I +
+    U)/4, and (I - U)/4 (they are the columns of the matrix returned by
+    :func:`stripeline._maptools.observe_sky`). The Q and U parameters must be
+    already measured in the celestial reference frame. The meaning of
+    ``pixidx`` and ``num_of_pixels`` is the same as in :func:`binned_map`.
+
+    The result is the same as calling :func:`binned_map` on the timelines I
+    = Q1 + Q2 + U1 + U2, Q = 2 (Q1 - Q2), and U = 2 (U1 - U2), but these are
+    never computed, and the TOD is read only once. Return a tuple containing
+    the I, Q, U, and hits maps. Unlike :func:`binned_map`, the hit map
+    always uses 64-bit integers, even if ``pixidx`` is an array of 32-bit
+    integers (which is not copied).'''
+
+    assert len(det_q1) == len(pixidx)
+    assert isinstance(num_of_pixels, int)
+    assert num_of_pixels > 0
+
+    pixidx = np.asarray(pixidx)
+    maps = [np.zeros(num_of_pixels) for _ in range(3)]
+    hits = np.zeros(num_of_pixels, dtype='int64')
+    if pixidx.dtype == np.int32:
+        _m.binned_map_detectors_i32(det_q1, det_q2, det_u1, det_u2, pixidx,
+                                    maps[0], maps[1], maps[2], hits)
+    else:
+        _m.binned_map_detectors(det_q1, det_q2, det_u1, det_u2,
+                                pixidx.astype('int64', copy=False),
+                                maps[0], maps[1], maps[2], hits)
+
+    return maps[0], maps[1], maps[2], hits
+
+
+def binned_map_detectors_ang(det_q1, det_q2, det_u1, det_u2, theta, phi,
+                             nside: int):
+    '''Produce I, Q, U maps from the outputs of a STRIP polarimeter.
+
+    This is the same as :func:`binned_map_detectors`, but instead of the
+    pixel indexes it takes the colatitude ``theta`` and the longitude
+    ``phi`` of each sample (in radians). The pixel indexes are computed
+    while binning the samples, like healpy.ang2pix would do for a map with
+    resolution ``nside`` in RING ordering, so that they are never stored in
+    memory. Return a tuple containing the I, Q, U, and hits maps.'''
+
+    assert len(det_q1) == len(theta)
+    assert len(theta) == len(phi)
+
+    num_of_pixels = healpy.nside2npix(nside)
+    maps = [np.zeros(num_of_pixels) for _ in range(3)]
+    hits = np.zeros(num_of_pixels, dtype='int64')
+    _m.binned_map_detectors_ang(nside, theta, phi,
+                                det_q1, det_q2, det_u1, det_u2,
+                                maps[0], maps[1], maps[2], hits)
+
+    return maps[0], maps[1], maps[2], hits
+
+
+def _reduce_strip_maps(comm, pixidx, local_maps, local_hits):
+    '''Combine the maps produced by each MPI process in :func:`binned_map_strip`
+
+    Only the range of pixels observed by at least one process is sent
+    through MPI: since STRIP observes a band of declinations, with RING
+    ordering this is usually a small fraction of the map. The maps are
+    packed in one buffer, so that they are reduced by a single call.'''
+
+    npix = len(local_hits)
+    if len(pixidx) > 0:
+        local_range = (int(np.min(pixidx)), int(np.max(pixidx)))
+    else:
+        local_range = (npix, -1)
+
+    ranges = comm.allgather(local_range)
+    first = min([x[0] for x in ranges])
+    last = max([x[1] for x in ranges])
+
+    global_maps = [np.zeros(npix) for _ in local_maps]
+    global_hits = np.zeros(npix, dtype=local_hits.dtype)
+    if first > last:
+        # No process has observed anything
+        return tuple(global_maps) + (global_hits,)
+
+    # Each binned map contains averages: multiply them by the number of hits
+    # to get sums, which can be added together
+    subset = slice(first, last + 1)
+    buf = np.empty((len(local_maps) + 1, last + 1 - first))
+    buf[0, :] = local_hits[subset]
+    for idx, cur_map in enumerate(local_maps):
+        np.multiply(cur_map[subset], buf[0, :], out=buf[idx + 1, :])
+
+    # The sums replace the local values, so no receive buffer is needed
+    from mpi4py import MPI
+    comm.Allreduce(MPI.IN_PLACE, buf)
+
+    # Normalize by the number of hits
+    global_hits[subset] = buf[0, :]
+    mask = buf[0, :] > 0
+    for idx, cur_map in enumerate(global_maps):
+        sums = buf[idx + 1, :]
+        cur_map[subset][mask] = sums[mask] / buf[0, mask]
+
+    return tuple(global_maps) + (global_hits,)
+
+
 def binned_map_strip(nside: int, toi_provider: tt.ToiProvider, comm=None):
     '''Compute a sky map from a set of TOI using a binning algorithm.
 
@@ -171,40 +300,27 @@ def binned_map_strip(nside: int, toi_provider: tt.ToiProvider, comm=None):
 
     Return a tuple containing the I, Q, U, and hits maps.'''
 
-    signals = np.array([toi_provider.get_signal(i) for i in range(4)])
-
-    # Compute Q and U and transform them in the celestial reference frame
-    q_cel, u_cel = pol.rotate_qu(q_from=2.0 * (signals[0, :] + signals[1, :]),
-                                 u_from=2.0 * (signals[2, :] + signals[3, :]),
-                                 psi=toi_provider.get_polarization_angle(),
-                                 inverse=True)
+    q1, q2, u1, u2 = toi_provider.get_all_signals()
 
-    # Compute the local maps
+    # Compute the local maps. Combining the detector outputs, rotating Q and
+    # U in the celestial reference frame, and binning them are all done in
+    # one pass by the Fortran routine. The 32-bit indexes returned by
+    # "get_pixel_index" are used as they are, without copying them
     npix = healpy.nside2npix(nside)
-    pixidx = toi_provider.get_pixel_index(nside=nside)
-    local_i, local_hits = binned_map(signal=np.sum(signals, axis=0),
-                                     pixidx=pixidx,
-                                     num_of_pixels=npix)
-    local_q, local_hits = binned_map(signal=q_cel,
-                                     pixidx=pixidx,
-                                     num_of_pixels=npix)
-    local_u, local_hits = binned_map(signal=u_cel,
-                                     pixidx=pixidx,
-                                     num_of_pixels=npix)
+    pixidx = np.asarray(toi_provider.get_pixel_index(nside=nside))
+    local_i, local_q, local_u = [np.zeros(npix) for _ in range(3)]
+    local_hits = np.zeros(npix, dtype='int64')
+    psi = toi_provider.get_polarization_angle()
+    if pixidx.dtype == np.int32:
+        _m.binned_map_iqu_i32(q1, q2, u1, u2, psi, pixidx,
+                              local_i, local_q, local_u, local_hits)
+    else:
+        _m.binned_map_iqu(q1, q2, u1, u2, psi,
+                          pixidx.astype('int64', copy=False),
+                          local_i, local_q, local_u, local_hits)
 
     if comm:
-        # Combine the maps produced by each MPI process
-        global_hits = comm.allreduce(local_hits)
-
-        global_i = comm.allreduce(local_i * local_hits)
-        global_q = comm.allreduce(local_q * local_hits)
-        global_u = comm.allreduce(local_u * local_hits)
-
-        # Normalize by the number of hits
-        mask = global_hits > 0
-        for cur_map in (global_i, global_q, global_u):
-            cur_map[mask] /= global_hits[mask]
-
-        return (global_i, global_q, global_u, global_hits)
+        return _reduce_strip_maps(comm, pixidx,
+                                  (local_i, local_q, local_u), local_hits)
 
     return (local_i, local_q, local_u, local_hits)
@@ -8,6 +8,8 @@ import stripeline.rng as rng
 class FlatRNG:
     'Random number generator with uniform distribution in the range [0, 1['
 
+    __slots__ = ('state',)
+
     def __init__(self, x_init=0, y_init=0, z_init=0, w_init=0):
         '''Initialize the random number generator.
 
@@ -37,20 +39,40 @@ class NormalRNG:
         sigma = 1.36
         num = mean + rng.next() * sigma
 
+    The parameter ``method`` selects the algorithm used to produce the
+    numbers: ``'polar'`` (the default) is Marsaglia's polar method, which
+    reproduces the sequences of absrand 1.1; ``'boxmuller'`` is the
+    Box-Muller transform, which never rejects a pair of uniform numbers
+    but produces a different sequence.
     '''
 
-    def __init__(self, x_init=0, y_init=0, z_init=0, w_init=0):
+    __slots__ = ('state', 'empty', 'gset', '_next_fn', '_fill_fn')
+
+    _METHODS = {
+        'polar': (rng.rand_normal, rng.fill_vector_normal),
+        'boxmuller': (rng.rand_normal_boxmuller,
+                      rng.fill_vector_normal_boxmuller),
+    }
+
+    def __init__(self, x_init=0, y_init=0, z_init=0, w_init=0,
+                 method='polar'):
+        try:
+            self._next_fn, self._fill_fn = NormalRNG._METHODS[method]
+        except KeyError:
+            raise ValueError('unknown method "{0}" for NormalRNG'
+                             .format(method))
+
         self.state = rng.init_rng(x_init, y_init, z_init, w_init)
         self.empty = np.ones(1, dtype='int8')
         self.gset = np.zeros(1, dtype='float64')
 
     def next(self):
         'Return a new pseudorandom number'
-        return rng.rand_normal(self.state, self.empty, self.gset)
+        return self._next_fn(self.state, self.empty, self.gset)
 
     def fill_vector(self, array):
         'Fill the ``array`` vector with a sequence of pseudorandom numbers'
-        rng.fill_vector_normal(self.state, self.empty, self.gset, array)
+        self._fill_fn(self.state, self.empty, self.gset, array)
 
 
 class Oof2RNG:
@@ -59,6 +81,8 @@ class Oof2RNG:
     The random numbers have zero mean.
     '''
 
+    __slots__ = ('flat_state', 'empty', 'gset', 'oof2_state')
+
     def __init__(self, fmin, fknee, fsample,
                  x_init=0, y_init=0, z_init=0, w_init=0):
         self.flat_state = rng.init_rng(x_init, y_init, z_init, w_init)
@@ -82,6 +106,8 @@ class OofRNG:
 
     The random numbers have zero mean. The value of a must be in the range [-2, 0).'''
 
+    __slots__ = ('flat_state', 'empty', 'gset', 'oof_state', 'num_of_states')
+
     def __init__(self, alpha, fmin, fknee, fsample,
                  x_init=0, y_init=0, z_init=0, w_init=0):
         self.flat_state = rng.init_rng(x_init, y_init, z_init, w_init)
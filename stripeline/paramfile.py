@@ -1,25 +1,63 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
+import copy
+import os.path
 from typing import Any, Dict, List
 import yaml
 
+from stripeline.instrumentdb import _YamlLoader, load_yaml_cached
 
-def load_yaml_files(file_names: List[str]) -> Dict[str, Any]:
+# Contents of the files already parsed by "load_yaml_files". For each
+# (absolute) path, this contains the modification time and the size of the
+# file when it was parsed, and the parsed object
+_parsed_files = {}  # type: Dict[str, Any]
+
+
+def _load_yaml_file(file_name: str, use_disk_cache=False) -> Any:
+    '''Parse a YAML file, unless it has already been parsed and has not
+    changed since then.
+
+    If ``use_disk_cache`` is True, files not yet parsed by this process are
+    loaded using :func:`stripeline.instrumentdb.load_yaml_cached`. A deep
+    copy of the cached object is returned, so that the caller can modify it
+    freely.'''
+
+    path = os.path.abspath(file_name)
+    file_stat = os.stat(path)
+    signature = (file_stat.st_mtime_ns, file_stat.st_size)
+
+    cached = _parsed_files.get(path)
+    if cached is None or cached[0] != signature:
+        if use_disk_cache:
+            cached = (signature, load_yaml_cached(path))
+        else:
+            with open(path, 'rt') as f:
+                cached = (signature, yaml.load(f, Loader=_YamlLoader))
+        _parsed_files[path] = cached
+
+    return copy.deepcopy(cached[1])
+
+
+def load_yaml_files(file_names: List[str],
+                    use_disk_cache=False) -> Dict[str, Any]:
     '''Create a dictionary using definitions from a set of yaml files.
 
     This function requires a list of file names in input, each in the YAML
     format. It produces one Python dictionary containing the set of keys and
     values from all the input files. If a key is found more than once, only the
     last definition will be used in the result. Therefore, the order in
-    specifying the input file names is significant.'''
+    specifying the input file names is significant.
+
+    The contents of each file are kept in memory, so that later calls do not
+    need to parse it again, unless its modification time or its size change.
+    If ``use_disk_cache`` is True, the parsed files are also saved on disk
+    (see :func:`stripeline.instrumentdb.load_yaml_cached`), so that other
+    processes and later runs can skip parsing them as well.'''
 
     parameters = dict()
 
     for cur_name in file_names:
-        with open(cur_name, 'rt') as f:
-            cur_parameters = yaml.load(f)
-        for key, value in cur_parameters.items():
-            parameters[key] = value
+        parameters.update(_load_yaml_file(cur_name, use_disk_cache))
 
-    return parameters     
+    return parameters
@@ -23,14 +23,19 @@ def rotate_qu(q_from, u_from, psi, inverse=False):
     assert len(q_from) == len(u_from)
     assert len(q_from) == len(psi)
 
+    # Compute "2 psi" only once, and reuse its memory to hold the sines
+    two_psi = 2.0 * np.asarray(psi, dtype='float64')
+    cos2psi = np.cos(two_psi)
+    sin2psi = np.sin(two_psi, out=two_psi)
     if inverse:
-        cos2psi = np.cos(-2.0 * psi)
-        sin2psi = np.sin(-2.0 * psi)
-    else:
-        cos2psi = np.cos(2.0 * psi)
-        sin2psi = np.sin(2.0 * psi)
-
-    q_to = cos2psi * q_from + sin2psi * u_from
-    u_to = -sin2psi * q_from + cos2psi * u_from
+        # cos(-x) = cos(x), sin(-x) = -sin(x)
+        np.negative(sin2psi, out=sin2psi)
+
+    # Accumulate in place, so that no temporary is created for the sums or
+    # for the negation of the sines
+    q_to = cos2psi * q_from
+    q_to += sin2psi * u_from
+    u_to = cos2psi * u_from
+    u_to -= sin2psi * q_from
 
     return q_to, u_to
@@ -36,6 +36,7 @@
 #include <math.h>
 #include <stdint.h>
 #include <stdlib.h>
+#include <string.h>
 
 const double PI = 3.14159265358979323846;
 const double scale_factor = 1.0 / (1.0 + (double)0xFFFFFFFF);
@@ -112,38 +113,112 @@ double rand_uniform(int32_t *state)
 
 /******************************************************************************/
 
+/* Compute the new value of the last element of the state of the RNG,
+ * given the first and the last elements of the state */
+#define XORSHIFT_STEP(first, last, result)                    \
+  {                                                           \
+    uint32_t tmp = (first) ^ ((first) << 11);                 \
+    result = ((last) ^ ((last) >> 19)) ^ (tmp ^ (tmp >> 8)); \
+  }
+
 /* Fill a vector with random uniform numbers */
 void fill_vector_uniform(int32_t *state, double *array, int num)
 {
+  /* The state is kept in local variables, so that the compiler can hold
+   * it in registers instead of re-reading it from memory at each step */
   uint32_t *ustate = (uint32_t *)state;
-  int i;
+  uint32_t x = ustate[0], y = ustate[1], z = ustate[2], w = ustate[3];
+  uint32_t next;
+  int i = 0;
 
-  for (i = 0; i < num; ++i)
+  /* Four steps replace the whole state: by overwriting the oldest
+   * element of the state at each step, no variable needs to be shifted */
+  for (; i + 4 <= num; i += 4)
   {
-    NEXT_STATE(ustate);
-    array[i] = ustate[3] * scale_factor;
+    XORSHIFT_STEP(x, w, x);
+    XORSHIFT_STEP(y, x, y);
+    XORSHIFT_STEP(z, y, z);
+    XORSHIFT_STEP(w, z, w);
+
+    array[i] = x * scale_factor;
+    array[i + 1] = y * scale_factor;
+    array[i + 2] = z * scale_factor;
+    array[i + 3] = w * scale_factor;
   }
+
+  for (; i < num; ++i)
+  {
+    XORSHIFT_STEP(x, w, next);
+    x = y;
+    y = z;
+    z = w;
+    w = next;
+    array[i] = w * scale_factor;
+  }
+
+  ustate[0] = x;
+  ustate[1] = y;
+  ustate[2] = z;
+  ustate[3] = w;
 }
 
 /******************************************************************************/
 
-double rand_normal(int32_t *state, int8_t *empty, double *gset)
+/* Draw two Gaussian numbers using Marsaglia's polar method. The first
+ * number is the one returned by "rand_normal", the second one is the one
+ * it keeps in "gset" for the next call */
+static void polar_normal_pair(uint32_t *ustate, double *first, double *second)
 {
-  if (*empty)
+  double v1, v2, rsq;
+  double fac;
+  do
   {
-    double v1, v2, rsq;
-    double fac;
-    do
-    {
-      v1 = 2.0 * rand_uniform(state) - 1.0;
-      v2 = 2.0 * rand_uniform(state) - 1.0;
-      rsq = v1 * v1 + v2 * v2;
-    } while ((rsq >= 1) || (rsq == 0));
+    NEXT_STATE(ustate);
+    v1 = 2.0 * (ustate[3] * scale_factor) - 1.0;
+    NEXT_STATE(ustate);
+    v2 = 2.0 * (ustate[3] * scale_factor) - 1.0;
+    rsq = v1 * v1 + v2 * v2;
+  } while ((rsq >= 1) || (rsq == 0));
+
+  fac = sqrt(-2.0 * log(rsq) / rsq);
+  *first = v2 * fac;
+  *second = v1 * fac;
+}
+
+/******************************************************************************/
 
-    fac = sqrt(-2.0 * log(rsq) / rsq);
-    *gset = v1 * fac;
+/* Draw two Gaussian numbers using the Box-Muller transform. Unlike the
+ * polar method, it never rejects a pair of uniform numbers, but it
+ * produces a different sequence */
+static void boxmuller_normal_pair(uint32_t *ustate, double *first,
+                                  double *second)
+{
+  double u1, u2, r;
+
+  /* Use 1 - u1, which is in ]0, 1], so that the logarithm is finite */
+  NEXT_STATE(ustate);
+  u1 = 1.0 - ustate[3] * scale_factor;
+  NEXT_STATE(ustate);
+  u2 = ustate[3] * scale_factor;
+
+  r = sqrt(-2.0 * log(u1));
+  *first = r * cos(2.0 * PI * u2);
+  *second = r * sin(2.0 * PI * u2);
+}
+
+/******************************************************************************/
+
+typedef void (*normal_pair_fn)(uint32_t *, double *, double *);
+
+static double next_normal(int32_t *state, int8_t *empty, double *gset,
+                          normal_pair_fn normal_pair)
+{
+  if (*empty)
+  {
+    double result;
+    normal_pair((uint32_t *)state, &result, gset);
     *empty = 0;
-    return v2 * fac;
+    return result;
   }
   else
   {
@@ -152,16 +227,69 @@ double rand_normal(int32_t *state, int8_t *empty, double *gset)
   }
 }
 
+static void fill_vector_pairs(int32_t *state, int8_t *empty, double *gset,
+                              double *array, int num,
+                              normal_pair_fn normal_pair)
+{
+  /* Work on a local copy of the state, which the compiler can keep in
+   * registers */
+  uint32_t ustate[4];
+  int i = 0;
+
+  memcpy(ustate, state, sizeof(ustate));
+
+  /* Start with the number kept by the last call, if there is one */
+  if (num > 0 && !*empty)
+  {
+    array[i++] = *gset;
+    *empty = 1;
+  }
+
+  /* Both numbers produced by the generator go directly in the array,
+   * without passing through "gset" */
+  for (; i + 2 <= num; i += 2)
+  {
+    normal_pair(ustate, array + i, array + i + 1);
+  }
+
+  /* If an odd number of samples is left, keep the second one for later */
+  if (i < num)
+  {
+    normal_pair(ustate, array + i, gset);
+    *empty = 0;
+  }
+
+  memcpy(state, ustate, sizeof(ustate));
+}
+
+/******************************************************************************/
+
+double rand_normal(int32_t *state, int8_t *empty, double *gset)
+{
+  return next_normal(state, empty, gset, polar_normal_pair);
+}
+
 /******************************************************************************/
 
 void fill_vector_normal(int32_t *state, int8_t *empty, double *gset,
                         double *array, int num)
 {
-  int i;
-  for (i = 0; i < num; ++i)
-  {
-    array[i] = rand_normal(state, empty, gset);
-  }
+  fill_vector_pairs(state, empty, gset, array, num, polar_normal_pair);
+}
+
+/******************************************************************************/
+
+double rand_normal_boxmuller(int32_t *state, int8_t *empty, double *gset)
+{
+  return next_normal(state, empty, gset, boxmuller_normal_pair);
+}
+
+/******************************************************************************/
+
+void fill_vector_normal_boxmuller(int32_t *state, int8_t *empty,
+                                  double *gset, double *array, int num)
+{
+  fill_vector_pairs(state, empty, gset, array, num, boxmuller_normal_pair);
 }
 
 /******************************************************************************/
@@ -293,8 +421,20 @@ void fill_vector_oof(int32_t *flat_state, int8_t *empty, double *gset,
                      double *array, int num)
 {
   int i;
+  int32_t j;
+
+  /* The filter does not change the sequence of Gaussian numbers, so these
+   * are drawn all at once. Each sample then goes through all the sections
+   * of the filter, like in "rand_oof": as every section depends only on
+   * its own state, the processor can overlap their computations */
+  fill_vector_normal(flat_state, empty, gset, array, num);
   for (i = 0; i < num; ++i)
   {
-    array[i] = rand_oof(flat_state, empty, gset, oof_state, oof_state_size);
+    double x2 = array[i];
+    for (j = 0; j < oof_state_size; ++j)
+    {
+      x2 = oof2_filter(oof_state + j * oof2_state_size(), x2);
+    }
+    array[i] = x2;
   }
 }
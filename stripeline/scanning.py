@@ -47,20 +47,30 @@ This module provides the class :class:`~stripeline.scanning.TodWriter`, which
 saves pointing information in FITS files.
 '''
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import logging as log
 import io
 import os.path
 import sys
 from typing import Any
 import click
-import healpy
 import numpy as np
 from astropy.io import fits
 import yaml
 
-import stripeline.quaternions as q
+import stripeline._scanning as _sc
 import stripeline.timetools as timetools
 
+# Use the libyaml-based loader and dumper if PyYAML has been compiled with it
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def _yaml_value(value):
+    # The safe YAML dumpers cannot represent NumPy scalars (e.g., np.float64)
+    return value.item() if isinstance(value, np.generic) else value
+
 
 class ScanningStrategy:
     '''Parameters of a sky scanning strategy.
@@ -89,6 +99,10 @@ class ScanningStrategy:
      :meth:`~stripeline.scanning.ScanningStrategy.load` and
      :meth:`~stripeline.scanning.ScanningStrategy.save`.'''
 
+    __slots__ = ('wheel1_rpm', 'wheel3_rpm', 'wheel1_angle0_deg',
+                 'wheel2_angle0_deg', 'wheel3_angle0_deg', 'latitude_deg',
+                 'overall_time_s', 'sampling_frequency_hz')
+
     def __init__(self,
                  wheel1_rpm=0.0,
                  wheel3_rpm=0.0,
@@ -143,15 +157,17 @@ class ScanningStrategy:
     def save(self, stream):
         '''Write a YAML representation of `self` into the stream.'''
 
-        yaml.dump({'wheel1_rpm': self.wheel1_rpm,
-                   'wheel3_rpm': self.wheel3_rpm,
-                   'wheel1_angle0_deg': self.wheel1_angle0_deg,
-                   'wheel2_angle0_deg': self.wheel2_angle0_deg,
-                   'wheel3_angle0_deg': self.wheel3_angle0_deg,
-                   'latitude_deg': self.latitude_deg,
-                   'overall_time_s': self.overall_time_s,
-                   'sampling_frequency_hz': self.sampling_frequency_hz},
+        yaml.dump({key: _yaml_value(getattr(self, key))
+                   for key in ('wheel1_rpm',
+                               'wheel3_rpm',
+                               'wheel1_angle0_deg',
+                               'wheel2_angle0_deg',
+                               'wheel3_angle0_deg',
+                               'latitude_deg',
+                               'overall_time_s',
+                               'sampling_frequency_hz')},
                   stream=stream,
+                  Dumper=_YamlDumper,
                   explicit_start=True,
                   explicit_end=True)
 
@@ -162,7 +178,7 @@ class ScanningStrategy:
         if isinstance(input, dict):
             d = input
         else:
-            d = yaml.load(input)
+            d = yaml.load(input, Loader=_YamlLoader)
 
         self.wheel1_rpm = d['wheel1_rpm']
         self.wheel3_rpm = d['wheel3_rpm']
@@ -191,7 +207,8 @@ def generate_pointings(scanning: ScanningStrategy,
                        dir_vec=[0, 0, 1],
                        num_of_chunks=1,
                        tod_callback=None,
-                       time0_s=0.0):
+                       time0_s=0.0,
+                       num_workers=1):
     '''Generate a set of pointing directions.
 
     Simulate the scanning of the sky with the parameters provided in `scanning`,
@@ -203,82 +220,138 @@ def generate_pointings(scanning: ScanningStrategy,
 
     The callback must accept the following parameters:
 
-    - `pointings`: 4xn matrix containing the time (in seconds), colatitude (in
+    - `pointings`: nx4 matrix containing the time (in seconds), colatitude (in
       radians), longitude (ditto), and polarization angle (ditto), each in its
-      own column;
+      own column (the matrix is in Fortran order, so each column is
+      contiguous in memory);
     - `scanning`: copy of the parameter passed to this function;
     - `dir_vec`: copy of the parameter passed to this function;
     - `index`: counter which keeps track of how many times the callback has been
       called, starting from 0.
+
+    If `num_workers` is greater than one, the chunks are computed in parallel
+    by a pool of threads. At most `num_workers` chunks are kept in memory at
+    the same time. The callback is always called from the calling thread,
+    in the same order as the chunks, so it does not need to be thread-safe.
     '''
-    x_vec = np.array([1, 0, 0])
-    z_vec = np.array([0, 0, 1])
+    # These quantities do not change from one chunk to the other
+    assert scanning.wheel1_rpm >= 0.0
+    assert scanning.wheel3_rpm >= 0.0
+    dir_vec_arr = np.asarray(dir_vec, dtype='float64')
+    wheel1_omega = 2 * np.pi * scanning.wheel1_rpm / 60.0
+    wheel3_omega = 2 * np.pi * scanning.wheel3_rpm / 60.0
+    wheel1_angle0 = np.deg2rad(scanning.wheel1_angle0_deg)
+    wheel2_angle0 = np.deg2rad(scanning.wheel2_angle0_deg)
+    wheel3_angle0 = np.deg2rad(scanning.wheel3_angle0_deg)
+    colatitude = np.deg2rad(90.0 - scanning.latitude_deg)
 
     chunks = timetools.split_time_range(time_length=scanning.overall_time_s,
                                         num_of_chunks=num_of_chunks,
                                         sampfreq=scanning.sampling_frequency_hz,
                                         time0=time0_s)
-    for chunk_idx, cur_chunk in enumerate(chunks):
-        start_time, samples_per_chunk = cur_chunk
 
-        time_vec = start_time + \
-            np.arange(samples_per_chunk) / scanning.sampling_frequency_hz
-
-        # Determine the angle of each wheel (the second wheel is the simplest)
-        wheel1_angle = np.deg2rad(scanning.wheel1_angle0_deg) + time_to_rot_angle(
-            time_vec, scanning.wheel1_rpm)
-        wheel3_angle = np.deg2rad(scanning.wheel3_angle0_deg) + time_to_rot_angle(
-            time_vec, scanning.wheel3_rpm)
-
-        tile_dir = np.reshape(np.tile(dir_vec, time_vec.size), (-1, 3))
-        tile_x = np.reshape(np.tile(x_vec, time_vec.size), (-1, 3))
-        tile_z = np.reshape(np.tile(z_vec, time_vec.size), (-1, 3))
-        # Build the wheel quaternions
-        qwheel1 = q.qfromaxisangle(tile_dir, wheel1_angle)
-        qwheel2 = np.reshape(
-            np.tile(
-                q.qfromaxisangle(
-                    [x_vec], [np.deg2rad(scanning.wheel2_angle0_deg)]),
-                time_vec.size), (-1, 4))
-        qwheel3 = q.qfromaxisangle(tile_z, wheel3_angle)
-
-        # This is in the ground's reference frame
-        ground_quat = q.qmul(qwheel3, q.qmul(qwheel2, qwheel1))
-
-        # Now we convert from the ground reference frame to the Earth's centre
-        location_quat = np.reshape(
-            np.tile(
-                q.qfromaxisangle(
-                    [x_vec], [np.deg2rad(90.0 - scanning.latitude_deg)]),
-                time_vec.size), (-1, 4))
-        earth_rot_quat = q.qfromaxisangle(tile_z,
-                                          2 * np.pi * time_vec / 86400.0)
-        quat = q.qmul(earth_rot_quat, q.qmul(location_quat, ground_quat))
-        dirs = q.qrotate(tile_dir, quat)
-        poldirs = q.qrotate(tile_x, quat)
-        theta, phi = healpy.vec2ang(dirs)
-
-        # The north direction for a vector v is just -dv/dtheta, as
-        # theta is the colatitude and moves along the meridian
-        thetapol, phipol = healpy.vec2ang(dirs)
-        northdir = np.column_stack((-np.cos(thetapol) * np.cos(phipol),
-                                    -np.cos(thetapol) * np.sin(phipol),
-                                    np.sin(thetapol)))
-
-        # The counterclockwise/clockwise measurement of the polarization angle
-        # is determined by the ordering of the terms in the call to "np.cross"
-        cos_psi = np.clip(np.sum(northdir * poldirs, axis=1), -1.0, 1.0)
-        cross = np.cross(northdir, poldirs)
-        sin_psi = np.clip(np.sum(cross * cross, axis=1), -1.0, 1.0)
-        psi = np.arctan2(sin_psi, cos_psi)
-        psi *= np.sign(np.sum(cross * dirs, axis=1))
+    def compute_chunk(cur_chunk):
+        start_time, samples_per_chunk = cur_chunk
 
+        # The whole chain of rotations (wheels, location on the Earth, and
+        # Earth's rotation) is computed sample by sample in one Fortran loop,
+        # without creating temporary arrays of quaternions. The result is
+        # written directly in the matrix passed to the callback. The Fortran
+        # routine releases the GIL, so it can run in many threads at once
+        return _sc.compute_pointings(
+            start_time=start_time,
+            sampling_frequency=scanning.sampling_frequency_hz,
+            dir_vec=dir_vec_arr,
+            wheel1_omega=wheel1_omega,
+            wheel3_omega=wheel3_omega,
+            wheel1_angle0=wheel1_angle0,
+            wheel2_angle0=wheel2_angle0,
+            wheel3_angle0=wheel3_angle0,
+            colatitude=colatitude,
+            nsamples=samples_per_chunk)
+
+    def call_callback(pointings, chunk_idx):
         if tod_callback is not None:
-            tod_callback(pointings=np.column_stack((time_vec, theta, phi, psi)),
+            tod_callback(pointings=pointings,
                          scanning=scanning,
                          dir_vec=dir_vec,
                          index=chunk_idx)
 
+    if num_workers <= 1:
+        for chunk_idx, cur_chunk in enumerate(chunks):
+            call_callback(compute_chunk(cur_chunk), chunk_idx)
+        return
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # Keep at most "num_workers" chunks in flight, and hand them to the
+        # callback in order while the following ones are being computed
+        pending = deque()
+        for chunk_idx, cur_chunk in enumerate(chunks):
+            if len(pending) == num_workers:
+                call_callback(pending.popleft().result(),
+                              chunk_idx - num_workers)
+            pending.append(executor.submit(compute_chunk, cur_chunk))
+
+        first_idx = len(chunks) - len(pending)
+        for idx, future in enumerate(pending):
+            call_callback(future.result(), first_idx + idx)
+
+
+def _pointings_hdu(pointings, scanning: ScanningStrategy, dir_vec, index: int,
+                   single_precision: bool):
+    'Return a table HDU containing the pointings of one chunk'
+
+    # "pointings" is in Fortran order, so each column is already a
+    # contiguous array and astropy does not need to gather it
+    angle_fmt = 'E' if single_precision else 'D'
+    cols = [
+        fits.Column(name=name, format=fmt, unit=unit,
+                    array=pointings[:, idx])
+        for idx, (name, fmt, unit) in enumerate((('TIME', 'D', 's'),
+                                                 ('THETA', angle_fmt, 'rad'),
+                                                 ('PHI', angle_fmt, 'rad'),
+                                                 ('PSI', angle_fmt, 'rad')))
+    ]
+    hdu = fits.BinTableHDU.from_columns(cols, name='TOD')
+    hdu.header['FSTTIME'] = (
+        pointings[0, 0], 'Time of the first sample in the file [s]')
+    hdu.header['LSTTIME'] = (
+        pointings[-1, 0], 'Time of the last sample in the file [s]')
+    hdu.header['DIRX'] = (dir_vec[0], 'X component of the beam axis')
+    hdu.header['DIRY'] = (dir_vec[1], 'Y component of the beam axis')
+    hdu.header['DIRZ'] = (dir_vec[2], 'Z component of the beam axis')
+    hdu.header['SAMPFREQ'] = (scanning.sampling_frequency_hz,
+                              'Sampling frequency [Hz]')
+    hdu.header['SITELAT'] = (
+        scanning.latitude_deg, 'Latitude of the site [deg]')
+    hdu.header['W1RPM'] = (scanning.wheel1_rpm,
+                           'Angular speed of wheel 1 [rpm]')
+    hdu.header['W3RPM'] = (scanning.wheel3_rpm,
+                           'Angular speed of wheel 3 [rpm]')
+    hdu.header['W1ANG0'] = (
+        scanning.wheel1_angle0_deg, 'Start angle for wheel 1 [deg]')
+    hdu.header['W2ANG0'] = (
+        scanning.wheel2_angle0_deg, 'Start angle for wheel 2 [deg]')
+    hdu.header['W3ANG0'] = (
+        scanning.wheel3_angle0_deg, 'Start angle for wheel 3 [deg]')
+    hdu.header['TIMELEN'] = (
+        scanning.overall_time_s, 'Time span of the *whole* sim [s]')
+    hdu.header['TODIDX'] = (index, '0-based index of this file')
+
+    return hdu
+
+
+def _scanning_primary_hdu(scanning: ScanningStrategy):
+    'Return a primary HDU containing the YAML description of "scanning"'
+
+    with io.StringIO() as primary_data:
+        scanning.save(stream=primary_data)
+        raw_bytes = np.frombuffer(primary_data.getvalue().encode('utf-8'),
+                                  dtype=np.uint8)
+        primhdu = fits.PrimaryHDU(data=raw_bytes)
+
+    return primhdu
+
 
 class TodWriter:
     '''Write a TOD.
@@ -297,13 +370,66 @@ class TodWriter:
     parameter to separate the files in chunks. The number of times `writer` is
     called depends on the parameter `num_of_chunks` passed to
     :meth:`~stripeline.scanning.generate_pointings`.
+
+    If `single_precision` is ``True``, the three angles are saved as 32-bit
+    floating-point numbers (their precision is ~1e-7 rad), which makes the
+    files smaller. Times are always saved in double precision, as they can
+    span very long intervals.
+
+    If `background` is ``True``, files are written to disk by a separate
+    thread, so that the next chunk can be computed in the meantime. In this
+    case you must call :meth:`~stripeline.scanning.TodWriter.close` (or use
+    the object in a ``with`` statement) to be sure that all the files have
+    been written::
+
+        with TodWriter(outdir='/storage', background=True) as writer:
+            generate_pointings(..., tod_callback=writer)
     '''
 
     def __init__(self,
                  outdir='.',
-                 file_name_mask='pointings_{index:04d}.fits'):
+                 file_name_mask='pointings_{index:04d}.fits',
+                 single_precision=False,
+                 background=False):
         self.outdir = outdir
         self.file_name_mask = file_name_mask
+        self.single_precision = single_precision
+        if background:
+            self._io_pool = ThreadPoolExecutor(max_workers=1)
+        else:
+            self._io_pool = None
+        self._pending_write = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Wait until all the files have been written.
+
+        If writing a file in the background failed, the exception is raised
+        here.'''
+
+        if self._io_pool is None:
+            return
+
+        try:
+            self._wait_pending_write()
+        finally:
+            self._io_pool.shutdown()
+            self._io_pool = None
+
+    def _wait_pending_write(self):
+        if self._pending_write is not None:
+            future, self._pending_write = self._pending_write, None
+            future.result()
+
+    @staticmethod
+    def _write(hdulist, file_name):
+        hdulist.writeto(file_name, overwrite=True)
+        log.info('file "%s" written successfully', file_name)
 
     def __call__(self,
                  pointings,
@@ -314,48 +440,80 @@ class TodWriter:
 
         file_name = os.path.join(self.outdir,
                                  self.file_name_mask.format(index=index))
-        cols = [
-            fits.Column(name=name, format=fmt, unit=unit, array=arr)
-            for name, fmt, unit, arr in (('TIME', 'D', 's', pointings[:, 0]),
-                                         ('THETA', 'D', 'rad',
-                                          pointings[:, 1]),
-                                         ('PHI', 'D', 'rad', pointings[:, 2]),
-                                         ('PSI', 'D', 'rad', pointings[:, 3]))
-        ]
-        hdu = fits.BinTableHDU.from_columns(cols, name='TOD')
-        hdu.header['FSTTIME'] = (
-            pointings[0, 0], 'Time of the first sample in the file [s]')
-        hdu.header['LSTTIME'] = (
-            pointings[-1, 0], 'Time of the last sample in the file [s]')
-        hdu.header['DIRX'] = (dir_vec[0], 'X component of the beam axis')
-        hdu.header['DIRY'] = (dir_vec[1], 'Y component of the beam axis')
-        hdu.header['DIRZ'] = (dir_vec[2], 'Z component of the beam axis')
-        hdu.header['SAMPFREQ'] = (scanning.sampling_frequency_hz,
-                                  'Sampling frequency [Hz]')
-        hdu.header['SITELAT'] = (
-            scanning.latitude_deg, 'Latitude of the site [deg]')
-        hdu.header['W1RPM'] = (scanning.wheel1_rpm,
-                               'Angular speed of wheel 1 [rpm]')
-        hdu.header['W3RPM'] = (scanning.wheel3_rpm,
-                               'Angular speed of wheel 3 [rpm]')
-        hdu.header['W1ANG0'] = (
-            scanning.wheel1_angle0_deg, 'Start angle for wheel 1 [deg]')
-        hdu.header['W2ANG0'] = (
-            scanning.wheel2_angle0_deg, 'Start angle for wheel 2 [deg]')
-        hdu.header['W3ANG0'] = (
-            scanning.wheel3_angle0_deg, 'Start angle for wheel 3 [deg]')
-        hdu.header['TIMELEN'] = (
-            scanning.overall_time_s, 'Time span of the *whole* sim [s]')
-        hdu.header['TODIDX'] = (index, '0-based index of this file')
-
-        with io.StringIO() as primary_data:
-            scanning.save(stream=primary_data)
-            raw_bytes = np.array(list(primary_data.getvalue().encode('utf-8')))
-            primhdu = fits.PrimaryHDU(data=raw_bytes)
+        hdu = _pointings_hdu(pointings, scanning, dir_vec, index,
+                             self.single_precision)
+        primhdu = _scanning_primary_hdu(scanning)
 
         hdulist = fits.HDUList([primhdu, hdu])
-        hdulist.writeto(file_name, clobber=True)
-        log.info('file "%s" written successfully', file_name)
+        if self._io_pool is None:
+            self._write(hdulist, file_name)
+        else:
+            # Creating the HDUs has already copied "pointings", so the
+            # caller can reuse it. Only one file at a time is kept in
+            # memory waiting to be written
+            self._wait_pending_write()
+            self._pending_write = self._io_pool.submit(self._write, hdulist,
+                                                       file_name)
+
+
+class SingleFileTodWriter:
+    '''Write all the chunks of a TOD in one FITS file.
+
+    This class works like :class:`~stripeline.scanning.TodWriter`, but
+    instead of creating one file per chunk it appends one table HDU per chunk
+    to the same file, which avoids opening and closing many files. All the
+    table HDUs are named ``TOD``, and the keyword ``EXTVER`` is the index of
+    the chunk plus one, so that chunk ``i`` can be read with
+    ``f['TOD', i + 1]``. The primary HDU contains the YAML description of the
+    scanning strategy.
+
+    The file must not be compressed, as it is kept open in append mode.
+    Call :meth:`~stripeline.scanning.SingleFileTodWriter.close` when all the
+    chunks have been written, or use the object in a ``with`` statement::
+
+        with SingleFileTodWriter('/storage/pointings.fits') as writer:
+            generate_pointings(..., tod_callback=writer)
+    '''
+
+    def __init__(self, file_name, single_precision=False):
+        self.file_name = file_name
+        self.single_precision = single_precision
+        self._hdulist = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Close the file.'''
+
+        if self._hdulist is not None:
+            self._hdulist.close()
+            self._hdulist = None
+
+    def __call__(self,
+                 pointings,
+                 scanning: ScanningStrategy,
+                 dir_vec,
+                 index: int):
+        '''Append a TOD to the FITS file'''
+
+        hdu = _pointings_hdu(pointings, scanning, dir_vec, index,
+                             self.single_precision)
+        hdu.ver = index + 1
+
+        if self._hdulist is None:
+            # The first chunk creates the file
+            fits.HDUList([_scanning_primary_hdu(scanning), hdu]).writeto(
+                self.file_name, overwrite=True)
+            self._hdulist = fits.open(self.file_name, mode='append')
+        else:
+            self._hdulist.append(hdu)
+            self._hdulist.flush()
+
+        log.info('chunk %d written to file "%s"', index, self.file_name)
 
 
 @click.command()
@@ -416,9 +574,18 @@ class TodWriter:
               help='Pointing direction of the main beam with respect to '
               'the focal plane (3D vector, written as a comma-separated list '
               'of 3 numbers)')
+@click.option('--jobs',
+              '-j',
+              'num_workers',
+              type=int,
+              default=1,
+              help='Number of threads used to compute the chunks in parallel')
+@click.option('--single-precision',
+              is_flag=True,
+              help='Save the angles as 32-bit floating-point numbers')
 def main(output_path, input_file, wheel1_rpm, wheel3_rpm, wheel1_angle0, wheel2_angle0,
          wheel3_angle0, latitude, time_length, sampfreq, num_of_chunks,
-         direction):
+         direction, num_workers, single_precision):
     '''This function is called when the script is ran from the command line.'''
 
     log.basicConfig(
@@ -461,11 +628,15 @@ def main(output_path, input_file, wheel1_rpm, wheel3_rpm, wheel1_angle0, wheel2_
 
     scanning.validate()
 
-    writer = TodWriter(output_path)
-    generate_pointings(scanning=scanning,
-                       dir_vec=direction,
-                       num_of_chunks=num_of_chunks,
-                       tod_callback=writer)
+    # Files are written by a background thread while the next chunk is
+    # being computed
+    with TodWriter(output_path, single_precision=single_precision,
+                   background=True) as writer:
+        generate_pointings(scanning=scanning,
+                           dir_vec=direction,
+                           num_of_chunks=num_of_chunks,
+                           tod_callback=writer,
+                           num_workers=num_workers)
 
 
 if __name__ == '__main__':
@@ -11,6 +11,7 @@ from astropy.io import fits
 from typing import Any, Dict, List
 import scanning
 import paramfile
+import _maptools
 
 
 class TodWriter:
@@ -21,9 +22,12 @@ class TodWriter:
                  parameters: Dict[str, Any],
                  outdir='.',
                  file_name_mask='TOI_{index:04d}.fits'):
-        self.sky_map_I = sky_map_I
-        self.sky_map_Q = sky_map_Q
-        self.sky_map_U = sky_map_U
+        # The maps are converted to 64-bit floating point numbers only once,
+        # so that _maptools.observe_sky does not copy them for every chunk
+        self.sky_map_I = np.asarray(sky_map_I, dtype='float64')
+        self.sky_map_Q = np.asarray(sky_map_Q, dtype='float64')
+        self.sky_map_U = np.asarray(sky_map_U, dtype='float64')
+        self.nside = healpy.get_nside(sky_map_Q)
         self.parameters = parameters
         self.outdir = outdir
         self.file_name_mask = file_name_mask
@@ -37,22 +41,19 @@ class TodWriter:
 
         file_name = os.path.join(self.outdir,
                                  self.file_name_mask.format(index=index))
-        pixidx = healpy.ang2pix(healpy.get_nside(
-            self.sky_map_Q), pointings[:, 1], pointings[:, 2])
-
-        TOI_I_sky = self.sky_map_I[pixidx]
-        TOI_Q_sky = self.sky_map_Q[pixidx]
-        TOI_U_sky = self.sky_map_U[pixidx]
-
-        TwoPsi = pointings[:, 3] * 2
-        TOI_I_beam = TOI_I_sky
-        TOI_Q_beam = TOI_Q_sky * np.cos(TwoPsi) - TOI_U_sky * np.sin(TwoPsi)
-        TOI_U_beam = TOI_Q_sky * np.sin(TwoPsi) + TOI_U_sky * np.cos(TwoPsi)
-
-        det_output_Q1 = 1 / 4 * (TOI_I_beam + TOI_Q_beam)
-        det_output_Q2 = 1 / 4 * (TOI_I_beam - TOI_Q_beam)
-        det_output_U1 = 1 / 4 * (TOI_I_beam + TOI_U_beam)
-        det_output_U2 = 1 / 4 * (TOI_I_beam - TOI_U_beam)
+        # Compute the pixel indexes, pick the Stokes parameters of the sky,
+        # rotate Q and U by -psi and combine them in the outputs of the
+        # detector in one pass, without creating temporary arrays (the
+        # result is the same as healpy.ang2pix + polarization.rotate_qu)
+        det_outputs = _maptools.observe_sky(self.nside,
+                                            pointings[:, 1],
+                                            pointings[:, 2],
+                                            pointings[:, 3],
+                                            self.sky_map_I,
+                                            self.sky_map_Q,
+                                            self.sky_map_U)
+        det_output_Q1, det_output_Q2, det_output_U1, det_output_U2 = \
+            det_outputs.T
 
         det_output_Q1 += np.random.normal(
             scale=self.parameters['wn_sigma_det_Q1_k'], size=len(det_output_Q1))
@@ -103,11 +104,12 @@ class TodWriter:
 
         with io.StringIO() as primary_data:
             scanning.save(stream=primary_data)
-            raw_bytes = np.array(list(primary_data.getvalue().encode('utf-8')))
+            raw_bytes = np.frombuffer(primary_data.getvalue().encode('utf-8'),
+                                      dtype=np.uint8)
             primhdu = fits.PrimaryHDU(data=raw_bytes)
 
         hdulist = fits.HDUList([primhdu, hdu])
-        hdulist.writeto(file_name, clobber=True)
+        hdulist.writeto(file_name, overwrite=True)
         log.info('file "%s" written successfully', file_name)
 
 
@@ -2,10 +2,22 @@
 # -*- encoding: utf-8 -*-
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import os
+import os.path
 from typing import List, Union
 import numpy as np
+import healpy
 from astropy.io import fits
 
+# fitsio is a thin wrapper around CFITSIO: if it is installed, it is used to
+# read TOIs, as it only reads the rows and columns that are requested
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
 
 TimeChunk = namedtuple('TimeChunk', 'start_time num_of_samples')
 
@@ -21,17 +33,14 @@ def split_time_range(time_length: float,
 
     delta_time = time_length / num_of_chunks
 
-    result = []
-    for chunk_idx in range(num_of_chunks):
-        # Determine the time of each sample in this chunk
-        cur_time = chunk_idx * delta_time
-        chunk_time0 = np.ceil(cur_time * sampfreq) / sampfreq - cur_time
-        start_time = time0 + cur_time + chunk_time0
-        num_of_samples = int(delta_time * sampfreq)
-        result.append(TimeChunk(start_time=start_time,
-                                num_of_samples=num_of_samples))
+    # Determine the time of the first sample in each chunk
+    cur_time = np.arange(num_of_chunks) * delta_time
+    chunk_time0 = np.ceil(cur_time * sampfreq) / sampfreq - cur_time
+    start_times = time0 + cur_time + chunk_time0
+    num_of_samples = int(delta_time * sampfreq)
 
-    return result
+    return [TimeChunk(start_time=start_time, num_of_samples=num_of_samples)
+            for start_time in start_times.tolist()]
 
 
 DET_NAMES = {'Q1': 0,
@@ -41,6 +50,14 @@ DET_NAMES = {'Q1': 0,
              }
 
 
+def _pixel_index_dtype(nside: int):
+    # The 32-bit type is used whenever all the pixel indexes fit in it
+    if healpy.nside2npix(nside) <= np.iinfo(np.int32).max:
+        return np.int32
+
+    return np.int64
+
+
 class ToiProvider:
     '''Load a TOI and split it evenly among MPI processes.
 
@@ -81,15 +98,24 @@ class ToiProvider:
         del det_idx
         return None
 
+    def get_all_signals(self):
+        '''Return a tuple containing the signals of the four detectors Q1, Q2,
+        U1, and U2 (see :func:`get_signal`).'''
+        return tuple(self.get_signal(i) for i in range(len(DET_NAMES)))
+
     def get_pixel_index(self, nside: int, nest=False, lonlat=False):
         '''Return a vector containing the pixel index for each sample in the
         TOI.
 
         Only the part of the TOI that belongs to the rank of this process is
-        returned.'''
+        returned. The indexes are 32-bit integers unless `nside` is so large
+        that they do not fit (NSIDE > 8192), as this halves the memory
+        needed by map-makers like :func:`stripeline.maptools.binned_map`.'''
 
-        theta, phi, psi = self.get_pointings()
-        return healpy.ang2pix(nside, theta, phi, nest=nest, lonlat=lonlat)
+        theta, phi = self.get_pointings()
+        return healpy.ang2pix(nside, theta, phi, nest=nest,
+                              lonlat=lonlat).astype(_pixel_index_dtype(nside),
+                                                    copy=False)
 
     def get_pointings(self):
         '''Return two vectors containing the colatitude and longitude for each
@@ -108,6 +134,12 @@ class ToiProvider:
 
         return None
 
+    def release_cache(self):
+        '''Free any data that the object keeps in memory between calls.
+
+        The base class does not cache anything, so this does nothing.'''
+        pass
+
 
 ToiFile = namedtuple('ToiFile', ['file_name', 'num_of_samples'])
 
@@ -115,14 +147,82 @@ ToiFile = namedtuple('ToiFile', ['file_name', 'num_of_samples'])
 def read_fits_file_information(file_name: str, hdu=1) -> ToiFile:
     '''Read the number of rows in the first tabular HDU of a FITS file
 
-    Return a :class:`stripeline.timetools.ToiFile` object.
+    Return a :class:`stripeline.timetools.ToiFile` object. Results are cached
+    as long as the modification time of the file does not change.
     '''
-    with fits.open(file_name) as fin:
+    return _read_fits_file_information(file_name, hdu,
+                                       os.path.getmtime(file_name))
+
+
+@lru_cache(maxsize=None)
+def _read_fits_file_information(file_name: str, hdu: int, mtime: float) -> ToiFile:
+    # "mtime" is only used as a key for the cache
+    del mtime
+
+    # Only the header of the HDU is needed, so avoid parsing the other HDUs
+    # and setting up a memory map for the data
+    with fits.open(file_name, memmap=False, lazy_load_hdus=True,
+                   do_not_scale_image_data=True) as fin:
         num_of_samples = fin[hdu].header['NAXIS2']
 
     return ToiFile(file_name=file_name, num_of_samples=num_of_samples)
 
 
+def clear_fits_info_cache():
+    '''Forget the results cached by :func:`read_fits_file_information`.
+
+    This is only needed if a file was rewritten without changing its
+    modification time (e.g., when it is rewritten twice within the same
+    second on file systems with a coarse resolution).'''
+    _read_fits_file_information.cache_clear()
+
+
+def _read_fits_files_information(file_names: List[str], comm=None,
+                                 num_workers=None) -> List[ToiFile]:
+    '''Call :func:`read_fits_file_information` on each file in `file_names`.
+
+    If `comm` is not None, every MPI process reads the headers of a subset of
+    the files, and the number of samples is then shared among all the
+    processes with one collective call. The result is the same on every
+    process.
+
+    Each process reads its headers using a pool of `num_workers` threads
+    (by default, one per CPU).'''
+
+    def read_all(names):
+        workers = num_workers
+        if workers is None:
+            workers = min(len(names), os.cpu_count() or 1)
+
+        if workers <= 1:
+            return [read_fits_file_information(x) for x in names]
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(read_fits_file_information, names))
+
+    file_names = list(file_names)
+    if comm is None:
+        return read_all(file_names)
+
+    rank, size = comm.Get_rank(), comm.Get_size()
+
+    # Process #r reads files r, r + size, r + 2 * size, etc.
+    local_sizes = np.array([x.num_of_samples
+                            for x in read_all(file_names[rank::size])],
+                           dtype='int64')
+    counts = [len(file_names[r::size]) for r in range(size)]
+    gathered = np.empty(len(file_names), dtype='int64')
+    comm.Allgatherv(local_sizes, [gathered, counts])
+
+    # "gathered" is sorted by rank: put it back in the same order as
+    # "file_names"
+    sizes = np.empty_like(gathered)
+    sizes[np.argsort(np.arange(len(file_names)) % size, kind='stable')] = gathered
+
+    return [ToiFile(file_name=name, num_of_samples=num)
+            for name, num in zip(file_names, sizes.tolist())]
+
+
 def split_into_n(length: int, num_of_segments: int) -> List[int]:
     '''Split a set of `length` elements into `num_of_segments` subsets.
 
@@ -136,9 +236,8 @@ def split_into_n(length: int, num_of_segments: int) -> List[int]:
     assert num_of_segments > 0
     assert length > num_of_segments
 
-    start_points = np.array([int(i * length / num_of_segments)
-                             for i in range(num_of_segments + 1)])
-    return start_points[1:] - start_points[:-1]
+    start_points = (np.arange(num_of_segments + 1) * length) // num_of_segments
+    return np.diff(start_points)
 
 
 def assign_toi_files_to_processes(samples_per_processes: List[int],
@@ -149,43 +248,45 @@ def assign_toi_files_to_processes(samples_per_processes: List[int],
     TOD and samples must be loaded by each process, using the principle that
     all the processes should read the same number of TODs, when possible.
 
-    Return a list of :class:`stripeline.timetools.ToiFile` objects.
+    Return a list containing, for each process, a list of
+    :class:`stripeline.timetools.ToiFileSegment` objects.
     '''
 
-    assert (sum(samples_per_processes) ==
-            sum([x.num_of_samples for x in tod_files]))
+    file_sizes = np.array([x.num_of_samples for x in tod_files], dtype='int64')
+    assert sum(samples_per_processes) == np.sum(file_sizes)
 
-    result = []  # Type: List[List[ToiFile]]
+    # Boundaries of the files and of the processes, in terms of the index of
+    # the sample in the whole TOI. Each file/process covers the half-open
+    # interval [start, end)
+    file_end = np.cumsum(file_sizes)
+    file_start = file_end - file_sizes
+    proc_end = np.cumsum(np.array(samples_per_processes, dtype='int64'))
+    proc_start = proc_end - samples_per_processes
 
-    file_idx = 0
-    element_idx = 0
-    # Iterate over the MPI processes
-    for samples_in_this_proc in samples_per_processes:
+    # Index of the file containing the first sample of each process
+    first_file = np.searchsorted(file_end, proc_start, side='right')
+
+    # Plain Python integers are faster to use in the loop below
+    file_start, file_end = file_start.tolist(), file_end.tolist()
+
+    result = []  # Type: List[List[ToiFileSegment]]
+    for cur_start, cur_end, file_idx in zip(proc_start.tolist(),
+                                            proc_end.tolist(),
+                                            first_file.tolist()):
         # This is the list of FITS segments that the current MPI process is
-        # going to load
+        # going to load: iterate only over the files overlapping with it
         segments = []  # Type: List[ToiFileSegment]
-        elements_in_this_segment = 0
-        # Iterate over the files to be read by the current MPI process
-        while elements_in_this_segment < samples_in_this_proc:
-            if elements_in_this_segment + (tod_files[file_idx].num_of_samples - element_idx) <= samples_in_this_proc:
-                # The whole FITS file is going to be read by the current MPI
-                # process
-                num = tod_files[file_idx].num_of_samples - element_idx
-                segments.append(ToiFileSegment(file_name=tod_files[file_idx].file_name,
-                                               first_element=element_idx,
-                                               num_of_elements=num))
-                elements_in_this_segment += num
-                file_idx += 1
-                element_idx = 0
-            else:
-                # This is the size of the segment we're going to append to "segments"
-                num = samples_in_this_proc - elements_in_this_segment
-                # Only a subset of this FITS file will be read by the current MPI process
-                segments.append(ToiFileSegment(file_name=tod_files[file_idx].file_name,
-                                               first_element=element_idx,
-                                               num_of_elements=num))
-                elements_in_this_segment += num
-                element_idx += num
+        while cur_start < cur_end:
+            num = min(cur_end, file_end[file_idx]) - cur_start
+            # Empty files do not contribute any segment
+            if num > 0:
+                # Positional arguments make the construction of namedtuples
+                # about twice as fast as keywords
+                segments.append(ToiFileSegment(tod_files[file_idx].file_name,
+                                               cur_start - file_start[file_idx],
+                                               num))
+            cur_start += num
+            file_idx += 1
 
         result.append(segments)
 
@@ -205,53 +306,164 @@ FitsTableLayout = namedtuple(
 )
 
 
-def _load_array_from_fits(segments: List[ToiFileSegment], cols_to_read: List[FitsColumn]):
+def _read_columns_astropy(file_name: str, cols_to_read: List[FitsColumn],
+                          start: int, outputs):
+    # Only the HDUs containing the columns are parsed, and all the columns
+    # are read while the file is open. The samples are copied in "outputs"
+    # before the file is closed, so that no array keeps the memory map (and
+    # the file descriptor) alive afterwards
+    with fits.open(file_name, memmap=True, lazy_load_hdus=True) as f:
+        for col, out in zip(cols_to_read, outputs):
+            out[:] = f[col.hdu].data.field(col.column)[start:start + len(out)]
+
+        for hdu in set(col.hdu for col in cols_to_read):
+            del f[hdu].data
+
+
+def _read_columns_fitsio(file_name: str, cols_to_read: List[FitsColumn],
+                         start: int, outputs):
+    # CFITSIO seeks directly to the rows to be read, and it does not parse
+    # the HDUs that are not used
+    with fitsio.FITS(file_name) as f:
+        for col, out in zip(cols_to_read, outputs):
+            out[:] = f[col.hdu].read_column(col.column,
+                                            rows=np.arange(start, start + len(out)))
+
+
+def _load_array_from_fits(segments: List[ToiFileSegment], cols_to_read: List[FitsColumn],
+                          num_workers=None, dtype=np.float64):
     '''Read a set of columns from a list of FITS files.
 
     The chunks to read from each FITS file are specified in the parameter `segments`,
     while the columns to read are in `cols_to_read`. The function returns a tuple
     containing all the data from the columns (each in a NumPy array) in the same
-    order as in `cols_to_read`.'''
+    order as in `cols_to_read`.
 
-    arrays = [np.array([], dtype=np.float64) for i in range(len(cols_to_read))]
-    for cur_segment in segments:
-        start = cur_segment.first_element
-        end = cur_segment.first_element + cur_segment.num_of_elements
-        with fits.open(cur_segment.file_name) as f:
-            # TODO: maybe this is not the most efficient way to load
-            # chunks of data from a FITS column
-            cur_chunk_arr = [f[x.hdu].data.field(x.column)[start:end]
-                             for x in cols_to_read]
-
-            for col_idx in range(len(cols_to_read)):
-                arrays[col_idx] = np.concatenate(
-                    [arrays[col_idx], cur_chunk_arr[col_idx]])
+    If the `fitsio` package is installed, it is used to read the files;
+    otherwise, the function falls back to `astropy.io.fits`.
+
+    The segments are read by a pool of `num_workers` threads, which helps when
+    the files are stored on slow or networked disks. By default, one thread per
+    CPU is used (but never more than the number of segments); pass 1 to read
+    the segments serially.
+
+    The arrays have type `dtype`: use ``np.float32`` to halve the memory
+    needed to keep the TOI in memory (this is harmless if the columns are
+    saved using single-precision numbers).'''
+
+    read_columns = _read_columns_fitsio if fitsio else _read_columns_astropy
+
+    # The size of the result is known in advance, so each segment is copied
+    # directly in its place
+    total = sum(x.num_of_elements for x in segments)
+    arrays = [np.empty(total, dtype=dtype) for i in range(len(cols_to_read))]
+
+    offsets = np.cumsum([0] + [x.num_of_elements for x in segments]).tolist()
+
+    def read_segment(seg_idx):
+        # Segments do not overlap, so threads never write the same elements
+        cur_segment = segments[seg_idx]
+        read_columns(cur_segment.file_name, cols_to_read,
+                     cur_segment.first_element,
+                     [x[offsets[seg_idx]:offsets[seg_idx + 1]] for x in arrays])
+
+    if num_workers is None:
+        num_workers = min(len(segments), os.cpu_count() or 1)
+
+    if num_workers <= 1:
+        for seg_idx in range(len(segments)):
+            read_segment(seg_idx)
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            # Consume the iterator, so that exceptions are propagated
+            list(pool.map(read_segment, range(len(segments))))
 
     return tuple(arrays)
 
 
+# Maximum number of samples whose pointings are kept in memory at the same
+# time by FitsToiProvider.get_pixel_index
+_PIXEL_INDEX_BLOCK_SIZE = 1 << 20
+
+
+def _split_segments_into_blocks(segments: List[ToiFileSegment], block_size: int):
+    '''Iterate over blocks of at most `block_size` consecutive samples.
+
+    Each block is a list of :class:`stripeline.timetools.ToiFileSegment`
+    objects: a block can span more than one segment, so that many small
+    files are read together.'''
+
+    block = []  # Type: List[ToiFileSegment]
+    block_len = 0
+    for cur_segment in segments:
+        first = cur_segment.first_element
+        remaining = cur_segment.num_of_elements
+        while remaining > 0:
+            num = min(remaining, block_size - block_len)
+            block.append(ToiFileSegment(cur_segment.file_name, first, num))
+            block_len += num
+            first += num
+            remaining -= num
+
+            if block_len == block_size:
+                yield block
+                block, block_len = [], 0
+
+    if block:
+        yield block
+
+
 class FitsToiProvider(ToiProvider):
     '''Distribute a TOI saved in FITS files among MPI processes.
 
     This class specializes :class:`stripeline.timetools.ToiProvider` in order to
-    load the TOI from a set of FITS files.'''
+    load the TOI from a set of FITS files. The parameter `num_workers` sets the
+    number of threads used to read the headers and the data of the files, and
+    `dtype` is the type of the arrays returned by the `get_*` methods (see
+    :func:`stripeline.timetools._load_array_from_fits`).
+
+    The colatitude, longitude and polarization angle are read together the
+    first time :func:`get_pointings` is called, and they are kept in memory
+    until :func:`stripeline.timetools.FitsToiProvider.release_cache` is
+    called. Until then, :func:`get_pixel_index` and
+    :func:`get_polarization_angle` read only the columns they need, without
+    caching them. The arrays returned by :func:`get_pointings` and
+    :func:`get_polarization_angle` can be shared with the cache, so they
+    should not be modified in place.
+
+    If `collective_io` is True and `comm` is not None, only the process with
+    rank 0 reads the FITS files, and it sends to every other process its part
+    of the TOI with ``comm.Scatterv``. This avoids opening the same files from
+    many processes, which can help when the file system is slow to open
+    files; in this case, all the processes must call the `get_*` methods
+    together.'''
 
     def __init__(self,
                  rank: int,
                  num_of_processes: int,
                  file_names: List[str],
                  file_layout: FitsTableLayout,
-                 comm=None):
+                 comm=None,
+                 num_workers=None,
+                 dtype=np.float64,
+                 collective_io=False):
         ToiProvider.__init__(self, rank, num_of_processes)
 
         self.file_layout = file_layout
-        self.fits_files = []  # Type: List[ToiFile]
-        if rank == 0 or comm is None:
-            for cur_file in file_names:
-                self.fits_files.append(read_fits_file_information(cur_file))
-
-        if comm:
-            self.fits_files = comm.bcast(self.fits_files, root=0)
+        self.comm = comm
+        self.collective_io = collective_io and (comm is not None)
+        self.num_workers = num_workers
+        self.dtype = dtype
+        # Tuple (theta, phi, psi), loaded on the first call to get_pointings
+        self._pointings_cache = None
+        # Used by "get_signal" when the detector is specified by name
+        self._signal_col_by_name = {
+            name: file_layout.signal_cols[idx]
+            for name, idx in DET_NAMES.items()
+            if idx < len(file_layout.signal_cols)
+        }
+        self.fits_files = _read_fits_files_information(file_names, comm,
+                                                       num_workers)
 
         self.total_num_of_samples = sum(
             [x.num_of_samples for x in self.fits_files])
@@ -261,15 +473,47 @@ class FitsToiProvider(ToiProvider):
         self.segments_per_process = assign_toi_files_to_processes(self.samples_per_process,
                                                                   self.fits_files)
 
+    def _load_columns(self, cols_to_read: List[FitsColumn]):
+        # This is the only method reading the TOI: each file is opened once,
+        # and all the columns in "cols_to_read" are read from it
+        if self.collective_io:
+            return self._load_columns_via_scatter(cols_to_read)
+
+        return _load_array_from_fits(segments=self.segments_per_process[self.rank],
+                                     cols_to_read=cols_to_read,
+                                     num_workers=self.num_workers,
+                                     dtype=self.dtype)
+
+    def _load_columns_via_scatter(self, cols_to_read: List[FitsColumn]):
+        counts = [int(x) for x in self.samples_per_process]
+        result = []
+        if self.rank == 0:
+            # The segments of all the processes, in order of rank, cover the
+            # whole TOI
+            all_segments = [x for segments in self.segments_per_process
+                            for x in segments]
+            whole_toi = _load_array_from_fits(segments=all_segments,
+                                              cols_to_read=cols_to_read,
+                                              num_workers=self.num_workers,
+                                              dtype=self.dtype)
+        else:
+            whole_toi = [None] * len(cols_to_read)
+
+        for column in whole_toi:
+            local = np.empty(counts[self.rank], dtype=self.dtype)
+            self.comm.Scatterv(None if column is None else [column, counts],
+                               local, root=0)
+            result.append(local)
+
+        return tuple(result)
+
     def get_time(self):
         '''Return a vector containing the time of each sample in the TOI.
 
         Only the part of the TOI that belongs to the rank of this process
         is returned.'''
 
-        result = _load_array_from_fits(segments=self.segments_per_process[self.rank],
-                                       cols_to_read=[self.file_layout.time_col])
-        return result[0]
+        return self._load_columns([self.file_layout.time_col])[0]
 
     def get_signal(self, det_idx: Union[int, str]):
         '''Return a vector containing the signal from the TOI.
@@ -288,12 +532,19 @@ class FitsToiProvider(ToiProvider):
         returned.'''
 
         if type(det_idx) is str:
-            det_idx = DET_NAMES[det_idx]
+            column = self._signal_col_by_name[det_idx]
+        else:
+            column = self.file_layout.signal_cols[det_idx]
+
+        return self._load_columns([column])[0]
 
-        result = _load_array_from_fits(segments=self.segments_per_process[self.rank],
-                                       cols_to_read=[self.file_layout.signal_cols[det_idx]])
+    def get_all_signals(self):
+        '''Return a tuple containing the signals of all the detectors.
 
-        return result[0]
+        This is faster than calling :func:`get_signal` once per detector, as
+        each FITS file is opened only once.'''
+
+        return self._load_columns(self.file_layout.signal_cols)
 
     def get_pointings(self):
         '''Return two vectors containing the colatitude and longitude for each
@@ -302,19 +553,68 @@ class FitsToiProvider(ToiProvider):
         Only the part of the TOI that belongs to the rank of this process is
         returned.'''
 
-        theta, phi = _load_array_from_fits(segments=self.segments_per_process[self.rank],
-                                           cols_to_read=[self.file_layout.theta_col,
-                                                         self.file_layout.phi_col])
-
+        theta, phi, _ = self._load_pointings()
         return theta, phi
 
     def get_polarization_angle(self):
-        '''Return two vectors containing the colatitude and longitude for each
-        sample in the TOI.
+        '''Return a vector containing the polarization angle for each sample
+        in the TOI.
+
         Only the part of the TOI that belongs to the rank of this process is
-        returned.'''
+        returned. If the pointings have not been loaded yet, only the column
+        with the polarization angle is read, and it is not kept in memory.'''
+
+        if self._pointings_cache is None:
+            return self._load_columns([self.file_layout.psi_col])[0]
+
+        return self._pointings_cache[2]
 
-        psi = _load_array_from_fits(segments=self.segments_per_process[self.rank],
-                                    cols_to_read=[self.file_layout.psi_col])
+    def get_pixel_index(self, nside: int, nest=False, lonlat=False):
+        '''Return a vector containing the pixel index for each sample in the
+        TOI.
 
-        return psi[0]
+        Only the part of the TOI that belongs to the rank of this process is
+        returned. Unless the pointings have already been loaded, they are
+        read in blocks and discarded as soon as the pixel indexes of each
+        block have been computed, so that the whole colatitude and longitude
+        vectors are never kept in memory. The type of the indexes is the same
+        as in :func:`stripeline.timetools.ToiProvider.get_pixel_index`.'''
+
+        # With collective I/O, reading the pointings block by block would
+        # need one Scatterv per block
+        if self._pointings_cache is not None or self.collective_io:
+            return ToiProvider.get_pixel_index(self, nside, nest=nest,
+                                               lonlat=lonlat)
+
+        segments = self.segments_per_process[self.rank]
+        pixidx = np.empty(sum(x.num_of_elements for x in segments),
+                          dtype=_pixel_index_dtype(nside))
+        offset = 0
+        for block in _split_segments_into_blocks(segments, _PIXEL_INDEX_BLOCK_SIZE):
+            theta, phi = _load_array_from_fits(segments=block,
+                                               cols_to_read=[self.file_layout.theta_col,
+                                                             self.file_layout.phi_col],
+                                               num_workers=self.num_workers,
+                                               dtype=self.dtype)
+            num = len(theta)
+            pixidx[offset:offset + num] = healpy.ang2pix(nside, theta, phi,
+                                                         nest=nest,
+                                                         lonlat=lonlat)
+            offset += num
+
+        return pixidx
+
+    def _load_pointings(self):
+        if self._pointings_cache is None:
+            self._pointings_cache = self._load_columns([self.file_layout.theta_col,
+                                                        self.file_layout.phi_col,
+                                                        self.file_layout.psi_col])
+
+        return self._pointings_cache
+
+    def release_cache(self):
+        '''Free the memory used by the pointings that have been loaded.
+
+        The next call to :func:`get_pointings`, :func:`get_polarization_angle`,
+        or :func:`get_pixel_index` will read them again from the FITS files.'''
+        self._pointings_cache = None
@@ -3,8 +3,13 @@
 
 'Test the functions in the instrumentdb module.'
 
+import os
 import os.path
+import tempfile
 import unittest as ut
+from unittest import mock
+
+import yaml
 
 import stripeline.instrumentdb as idb
 
@@ -18,3 +23,17 @@ class TestInstrumentDb(ut.TestCase):
                           idb.scanning_strategy_db_file_name()):
             self.assertTrue(os.path.exists(file_name),
                             'File "{0}" not found'.format(file_name))
+
+    def test_load_yaml_cached(self):
+        with open(idb.focal_plane_db_file_name(), 'rt') as f:
+            expected = yaml.safe_load(f)
+
+        with tempfile.TemporaryDirectory() as cache_home:
+            with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home}):
+                # The first call parses the file and fills the cache, the
+                # second one reads the cache
+                self.assertEqual(idb.load_yaml_cached(idb.focal_plane_db_file_name()),
+                                 expected)
+                self.assertEqual(len(os.listdir(idb.yaml_cache_path())), 1)
+                self.assertEqual(idb.load_yaml_cached(idb.focal_plane_db_file_name()),
+                                 expected)
@@ -4,6 +4,10 @@
 import unittest as ut
 
 import stripeline.maptools as mt
+import stripeline._maptools as _m
+import stripeline.polarization as pol
+import stripeline.timetools as tt
+import healpy
 import numpy as np
 from mpi4py import MPI
 
@@ -26,7 +30,22 @@ class TestMaptools(ut.TestCase):
              1.2071067811865475, 0.9330127018922193, 0.75]
         ])
 
-        self.assertTrue(np.allclose(expected, cond.matr))
+        self.assertTrue(np.allclose(np.reshape(expected, (2, 3, 3)),
+                                    cond.matr))
+
+    def test_condmatr_map(self):
+        cond = mt.ConditionMatrix(numpix=4)
+        cond.update(pixidx=np.array([0, 0, 0], dtype='int32'),
+                    angle=np.array([0.0, 1. / 8., 1. / 4.]) * np.pi)
+        cond.update(pixidx=np.array([1, 1, 1], dtype='int32'),
+                    angle=np.array([0.0, 1. / 12., 1. / 8.]) * np.pi)
+        # Pixel #2 is seen with one angle only, pixel #3 is never seen
+        cond.update(pixidx=np.array([2, 2], dtype='int32'),
+                    angle=np.array([0.0, 0.0]))
+
+        expected = np.array([0.006958762128619788, 0.0002714992569925208,
+                             0.0, 0.0])
+        self.assertTrue(np.allclose(expected, cond.to_map()))
 
 
 class TestMapMakers(ut.TestCase):
@@ -51,12 +70,101 @@ class TestMapMakers(ut.TestCase):
                         "reference = {0}, result = {1}".format(reference_map, pixels))
         self.assertTrue(np.array_equal(np.array([2, 0, 3, 1]), hits))
 
+    def testBinnedMapInt32(self):
+        reference_map = np.array([5.0, 0.0, 2.0, -1.0])
+        pixidx = np.array([0, 2, 2, 3, 0, 2], dtype='int32')
+        signal = np.array([4.0, 1.0, 2.0, -1.0, 6.0, 3.0])
+
+        pixels, hits = mt.binned_map(signal, pixidx, 4)
+        self.assertTrue(np.allclose(reference_map, pixels),
+                        "reference = {0}, result = {1}".format(reference_map, pixels))
+        self.assertTrue(np.array_equal(np.array([2, 0, 3, 1]), hits))
+        self.assertEqual(hits.dtype, np.int32)
+
+    def testBinnedMapIQU(self):
+        npix = 12
+        rng = np.random.RandomState(2)
+        pixidx = rng.randint(0, npix - 1, 1000)
+        q1, q2, u1, u2 = rng.normal(size=(4, len(pixidx)))
+        psi = rng.uniform(0.0, np.pi, len(pixidx))
+
+        q_cel, u_cel = pol.rotate_qu(2 * (q1 + q2), 2 * (u1 + u2), psi,
+                                     inverse=True)
+        for kernel, dtype in ((_m.binned_map_iqu, 'int64'),
+                              (_m.binned_map_iqu_i32, 'int32')):
+            maps = [np.zeros(npix) for _ in range(3)]
+            hits = np.zeros(npix, dtype='int64')
+            kernel(q1, q2, u1, u2, psi, pixidx.astype(dtype), *maps, hits)
+
+            for cur_map, signal in zip(maps, (q1 + q2 + u1 + u2, q_cel, u_cel)):
+                expected, expected_hits = mt.binned_map(signal, pixidx, npix)
+                self.assertTrue(np.allclose(cur_map, expected))
+                self.assertTrue(np.array_equal(hits, expected_hits))
+
+            # The last pixel is never observed
+            self.assertEqual(hits[-1], 0)
+
+    def testBinnedMapDetectors(self):
+        npix = 12
+        rng = np.random.RandomState(3)
+        pixidx = rng.randint(0, npix - 1, 1000)
+        q1, q2, u1, u2 = rng.normal(size=(4, len(pixidx)))
+
+        for dtype in ('int64', 'int32'):
+            result = mt.binned_map_detectors(q1, q2, u1, u2,
+                                             pixidx.astype(dtype), npix)
+            for cur_map, signal in zip(result, (q1 + q2 + u1 + u2,
+                                                2 * (q1 - q2), 2 * (u1 - u2))):
+                expected, expected_hits = mt.binned_map(signal, pixidx, npix)
+                self.assertTrue(np.allclose(cur_map, expected))
+                self.assertTrue(np.array_equal(result[3], expected_hits))
+
+    def testBinnedMapDetectorsAng(self):
+        nside = 4
+        rng = np.random.RandomState(4)
+        theta = np.concatenate([rng.uniform(0.0, np.pi, 2000),
+                                rng.uniform(0.0, 0.01, 100),
+                                np.pi - rng.uniform(0.0, 0.01, 100)])
+        phi = rng.uniform(-2 * np.pi, 4 * np.pi, len(theta))
+        q1, q2, u1, u2 = rng.normal(size=(4, len(theta)))
+
+        result = mt.binned_map_detectors_ang(q1, q2, u1, u2, theta, phi, nside)
+        expected = mt.binned_map_detectors(q1, q2, u1, u2,
+                                           healpy.ang2pix(nside, theta, phi),
+                                           healpy.nside2npix(nside))
+        for cur_map, expected_map in zip(result[0:3], expected[0:3]):
+            self.assertTrue(np.allclose(cur_map, expected_map))
+        self.assertTrue(np.array_equal(result[3], expected[3]))
+
+    def testObserveSky(self):
+        nside = 16
+        npix = healpy.nside2npix(nside)
+        rng = np.random.RandomState(1)
+        # Include directions close to the poles, where Healpix uses a
+        # different formula
+        theta = np.concatenate([rng.uniform(0.0, np.pi, 5000),
+                                rng.uniform(0.0, 0.01, 100),
+                                np.pi - rng.uniform(0.0, 0.01, 100)])
+        phi = rng.uniform(-2 * np.pi, 4 * np.pi, len(theta))
+        psi = rng.uniform(0.0, np.pi, len(theta))
+        sky_i, sky_q, sky_u = rng.normal(size=(3, npix))
+
+        det = _m.observe_sky(nside, theta, phi, psi, sky_i, sky_q, sky_u)
+
+        pixidx = healpy.ang2pix(nside, theta, phi)
+        q_beam, u_beam = pol.rotate_qu(sky_q[pixidx], sky_u[pixidx], psi,
+                                       inverse=True)
+        for col, expected in enumerate((sky_i[pixidx] + q_beam,
+                                        sky_i[pixidx] - q_beam,
+                                        sky_i[pixidx] + u_beam,
+                                        sky_i[pixidx] - u_beam)):
+            self.assertTrue(np.allclose(det[:, col], expected / 4))
+
 
 # This class is used to provide some mock data for the MPI-based tests
-class MockToiProvider:
+class MockToiProvider(tt.ToiProvider):
     def __init__(self, rank):
-        self.rank = rank
-        self.num_of_processes = 2
+        tt.ToiProvider.__init__(self, rank=rank, num_of_processes=2)
 
         self.map_q = np.zeros(12)
         self.map_q[0] = 1.0
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 # -*- encoding: utf-8 -*-
 
+import os
+import os.path
+import tempfile
 import unittest as ut
+from unittest import mock
 import stripeline.paramfile as pf
 
 
@@ -12,4 +16,34 @@ class Test_paramfile(ut.TestCase):
         self.assertEqual(len(parameters.keys()), 3)
         self.assertEqual(parameters['alpha'], 2)
         self.assertEqual(parameters['wn'], 3)
-        self.assertEqual(parameters['beta'], 2)
\ No newline at end of file
+        self.assertEqual(parameters['beta'], 2)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_name = os.path.join(tmpdir, 'params.yaml')
+            with open(file_name, 'wt') as f:
+                f.write('alpha: [1, 2]\n')
+
+            parameters = pf.load_yaml_files([file_name])
+            self.assertEqual(parameters['alpha'], [1, 2])
+
+            # Modifying the result must not change the cached copy
+            parameters['alpha'].append(3)
+            self.assertEqual(pf.load_yaml_files([file_name])['alpha'], [1, 2])
+
+            # Changing the file must invalidate the cache
+            with open(file_name, 'wt') as f:
+                f.write('alpha: [4, 5, 6]\n')
+            os.utime(file_name, ns=(0, 0))
+            self.assertEqual(pf.load_yaml_files([file_name])['alpha'], [4, 5, 6])
+
+    def test_disk_cache(self):
+        file_names = ['tests/test1.yaml', 'tests/test2.yaml']
+        with tempfile.TemporaryDirectory() as cache_home:
+            with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home}):
+                # Make sure that the files are not already in memory
+                pf._parsed_files.clear()
+                parameters = pf.load_yaml_files(file_names, use_disk_cache=True)
+                self.assertEqual(parameters, pf.load_yaml_files(file_names))
+                self.assertEqual(
+                    len(os.listdir(os.path.join(cache_home, 'stripeline'))), 2)
@@ -5,6 +5,9 @@ import stripeline.noisegen as ng
 import unittest as ut
 import numpy as np
 
+# The reference values have ten decimal digits
+REF_ATOL = 1e-10
+
 FLAT_REF_ARRAY = np.array([0.9854981268, 0.2536861135,
                            0.8791850018, 0.8541532028,
                            0.4161281283, 0.6491611481,
@@ -69,7 +72,12 @@ class TestFlatRNG(ut.TestCase):
         rng = ng.FlatRNG()
         result = np.empty(len(FLAT_REF_ARRAY))
         rng.fill_vector(result)
-        self.assertTrue(np.allclose(result, FLAT_REF_ARRAY))
+        np.testing.assert_allclose(result, FLAT_REF_ARRAY, rtol=0, atol=REF_ATOL)
+
+        # "next" and "fill_vector" must produce exactly the same numbers
+        rng = ng.FlatRNG()
+        np.testing.assert_array_equal(result,
+                                      [rng.next() for _ in range(len(result))])
 
 
 class TestNormalRNG(ut.TestCase):
@@ -88,7 +96,29 @@ class TestNormalRNG(ut.TestCase):
         rng = ng.NormalRNG()
         result = np.empty(len(NORMAL_REF_ARRAY))
         rng.fill_vector(result)
-        self.assertTrue(np.allclose(result, NORMAL_REF_ARRAY))
+        np.testing.assert_allclose(result, NORMAL_REF_ARRAY, rtol=0, atol=REF_ATOL)
+
+        # "next" and "fill_vector" must produce exactly the same numbers
+        rng = ng.NormalRNG()
+        np.testing.assert_array_equal(result,
+                                      [rng.next() for _ in range(len(result))])
+
+    def test_boxmuller(self):
+        'Check the statistics and the consistency of the Box-Muller method'
+
+        rng = ng.NormalRNG(method='boxmuller')
+        result = np.empty(100001)
+        rng.fill_vector(result)
+        self.assertAlmostEqual(np.mean(result), 0.0, delta=0.01)
+        self.assertAlmostEqual(np.std(result), 1.0, delta=0.01)
+
+        # "next" and "fill_vector" must produce the same sequence
+        rng = ng.NormalRNG(method='boxmuller')
+        first = np.array([rng.next() for i in range(5)])
+        np.testing.assert_array_equal(first, result[:5])
+
+        with self.assertRaises(ValueError):
+            ng.NormalRNG(method='unknown')
 
 
 class TestOof2RNG(ut.TestCase):
@@ -107,7 +137,12 @@ class TestOof2RNG(ut.TestCase):
         rng = ng.Oof2RNG(**OOF2_REF_PARAMS)
         result = np.empty(len(OOF2_REF_ARRAY))
         rng.fill_vector(result)
-        self.assertTrue(np.allclose(result, OOF2_REF_ARRAY))
+        np.testing.assert_allclose(result, OOF2_REF_ARRAY, rtol=0, atol=REF_ATOL)
+
+        # "next" and "fill_vector" must produce exactly the same numbers
+        rng = ng.Oof2RNG(**OOF2_REF_PARAMS)
+        np.testing.assert_array_equal(result,
+                                      [rng.next() for _ in range(len(result))])
 
 
 class TestOofRNG(ut.TestCase):
@@ -126,7 +161,12 @@ class TestOofRNG(ut.TestCase):
         rng = ng.OofRNG(**OOF_REF_PARAMS)
         result = np.empty(len(OOF_REF_ARRAY))
         rng.fill_vector(result)
-        self.assertTrue(np.allclose(result, OOF_REF_ARRAY))
+        np.testing.assert_allclose(result, OOF_REF_ARRAY, rtol=0, atol=REF_ATOL)
+
+        # "next" and "fill_vector" must produce exactly the same numbers
+        rng = ng.OofRNG(**OOF_REF_PARAMS)
+        np.testing.assert_array_equal(result,
+                                      [rng.next() for _ in range(len(result))])
 
 
 if __name__ == '__main__':
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 # -*- encoding: utf-8 -*-
 
+import io
+import os.path
+import tempfile
 import unittest as ut
 
 import stripeline.scanning as sc
+import stripeline.quaternions as q
+import healpy
 import numpy as np
+from astropy.io import fits
 
 
 class PointingStorage:
@@ -45,6 +51,23 @@ class TestScanning(ut.TestCase):
         ])))
 
 
+    def test_polarization_angle_45deg(self):
+        # Angles which are not multiples of 90 degrees must be correct too
+        storage = PointingStorage()
+        scanning = sc.ScanningStrategy(wheel3_rpm=60.0,
+                                       latitude_deg=0.0,  # Equator
+                                       overall_time_s=1.0,
+                                       sampling_frequency_hz=8.0)
+
+        sc.generate_pointings(scanning=scanning, dir_vec=[0, 0, 1],
+                              num_of_chunks=1, tod_callback=storage)
+
+        expected = np.deg2rad([-90.0, -45.0, 0.0, 45.0,
+                               90.0, 135.0, 180.0, 225.0])
+        # Compare the angles modulo 2pi
+        diff = np.angle(np.exp(1j * (storage.psi - expected)))
+        self.assertTrue(np.allclose(diff, 0.0), 'psi is {0}'.format(storage.psi))
+
     def test_dir_vec(self):
         # Checks that bug #11 does not appear again
         storage = PointingStorage()
@@ -63,3 +86,172 @@ class TestScanning(ut.TestCase):
         self.assertTrue(np.allclose(storage.theta, np.deg2rad([
             90.0, 0.0, 90.0, 180.0
         ])), "theta is {0}".format(storage.theta))
+
+    def test_quaternions(self):
+        # Compare the pointings with the ones computed by chaining the
+        # rotations through the functions in stripeline.quaternions
+        storage = PointingStorage()
+        scanning = sc.ScanningStrategy(wheel1_rpm=1.5,
+                                       wheel3_rpm=2.0,
+                                       wheel1_angle0_deg=10.0,
+                                       wheel2_angle0_deg=30.0,
+                                       wheel3_angle0_deg=45.0,
+                                       latitude_deg=28.3,
+                                       overall_time_s=10.0,
+                                       sampling_frequency_hz=2.0)
+        dir_vec = np.array([0.0, 0.6, 0.8])
+
+        sc.generate_pointings(scanning=scanning, dir_vec=dir_vec,
+                              num_of_chunks=1, tod_callback=storage)
+
+        num = storage.time.size
+        x_vec, z_vec = np.tile([1.0, 0.0, 0.0], (num, 1)), np.tile([0.0, 0.0, 1.0], (num, 1))
+        wheel1 = q.qfromaxisangle(np.tile(dir_vec, (num, 1)),
+                                  np.deg2rad(10.0) + sc.time_to_rot_angle(storage.time, 1.5))
+        wheel2 = q.qfromaxisangle(x_vec, np.ones(num) * np.deg2rad(30.0))
+        wheel3 = q.qfromaxisangle(z_vec,
+                                  np.deg2rad(45.0) + sc.time_to_rot_angle(storage.time, 2.0))
+        location = q.qfromaxisangle(x_vec, np.ones(num) * np.deg2rad(90.0 - 28.3))
+        earth = q.qfromaxisangle(z_vec, 2 * np.pi * storage.time / 86400.0)
+        quat = q.qmul(earth, q.qmul(location, q.qmul(wheel3, q.qmul(wheel2, wheel1))))
+        theta, phi = healpy.vec2ang(q.qrotate(np.tile(dir_vec, (num, 1)), quat))
+
+        self.assertTrue(np.allclose(storage.theta, theta))
+        self.assertTrue(np.allclose(storage.phi, phi))
+
+    def test_tod_writer(self):
+        storage = PointingStorage()
+        scanning = sc.ScanningStrategy(wheel3_rpm=1.0,
+                                       latitude_deg=28.3,
+                                       overall_time_s=10.0,
+                                       sampling_frequency_hz=5.0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = sc.TodWriter(outdir=tmpdir)
+
+            def callback(**kwargs):
+                storage(**kwargs)
+                writer(**kwargs)
+
+            # Run twice, to check that existing files are overwritten
+            for _ in range(2):
+                sc.generate_pointings(scanning=scanning, dir_vec=[0, 0, 1],
+                                      num_of_chunks=1, tod_callback=callback)
+
+            with fits.open(os.path.join(tmpdir, 'pointings_0000.fits')) as f:
+                tod = f['TOD'].data
+                self.assertTrue(np.allclose(tod.field('TIME'), storage.time))
+                self.assertTrue(np.allclose(tod.field('THETA'), storage.theta))
+                self.assertTrue(np.allclose(tod.field('PHI'), storage.phi))
+                self.assertTrue(np.allclose(tod.field('PSI'), storage.psi))
+
+                # The primary HDU contains the YAML description of the
+                # scanning strategy
+                loaded = sc.ScanningStrategy()
+                loaded.load(f[0].data.tobytes().decode('utf-8'))
+                self.assertEqual(loaded.latitude_deg, 28.3)
+
+    def test_tod_writer_single_precision(self):
+        storage = PointingStorage()
+        scanning = sc.ScanningStrategy(wheel3_rpm=1.0,
+                                       latitude_deg=28.3,
+                                       overall_time_s=10.0,
+                                       sampling_frequency_hz=5.0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = sc.TodWriter(outdir=tmpdir, single_precision=True)
+
+            def callback(**kwargs):
+                storage(**kwargs)
+                writer(**kwargs)
+
+            sc.generate_pointings(scanning=scanning, dir_vec=[0, 0, 1],
+                                  num_of_chunks=1, tod_callback=callback)
+
+            with fits.open(os.path.join(tmpdir, 'pointings_0000.fits')) as f:
+                tod = f['TOD'].data
+                self.assertEqual(tod.columns['TIME'].format, 'D')
+                self.assertEqual(tod.columns['THETA'].format, 'E')
+                self.assertTrue(np.allclose(tod.field('TIME'), storage.time))
+                self.assertTrue(np.allclose(tod.field('THETA'), storage.theta))
+
+    def test_num_workers(self):
+        scanning = sc.ScanningStrategy(wheel1_rpm=1.5,
+                                       wheel3_rpm=2.0,
+                                       wheel2_angle0_deg=30.0,
+                                       latitude_deg=28.3,
+                                       overall_time_s=70.0,
+                                       sampling_frequency_hz=10.0)
+
+        results = {}
+        for num_workers in (1, 3):
+            chunks = []
+            sc.generate_pointings(scanning=scanning, dir_vec=[0, 0, 1],
+                                  num_of_chunks=7, num_workers=num_workers,
+                                  tod_callback=lambda pointings, index, **kwargs:
+                                  chunks.append((index, pointings)))
+            results[num_workers] = chunks
+
+        self.assertEqual([idx for idx, _ in results[3]], list(range(7)))
+        for (_, serial), (_, parallel) in zip(results[1], results[3]):
+            self.assertTrue(np.array_equal(serial, parallel))
+
+    def test_tod_writer_background(self):
+        scanning = sc.ScanningStrategy(wheel3_rpm=1.0,
+                                       latitude_deg=28.3,
+                                       overall_time_s=10.0,
+                                       sampling_frequency_hz=5.0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with sc.TodWriter(outdir=tmpdir, background=True) as writer:
+                sc.generate_pointings(scanning=scanning, dir_vec=[0, 0, 1],
+                                      num_of_chunks=3, tod_callback=writer)
+
+            for index in range(3):
+                file_name = os.path.join(tmpdir,
+                                         'pointings_{0:04d}.fits'.format(index))
+                with fits.open(file_name) as f:
+                    self.assertEqual(f['TOD'].header['TODIDX'], index)
+                    self.assertEqual(len(f['TOD'].data), 16)
+
+    def test_yaml(self):
+        scanning = sc.ScanningStrategy(wheel1_rpm=1.5,
+                                       wheel3_rpm=np.float64(2.0),
+                                       wheel2_angle0_deg=30.0,
+                                       latitude_deg=28.3,
+                                       overall_time_s=70.0,
+                                       sampling_frequency_hz=10.0)
+
+        with io.StringIO() as stream:
+            scanning.save(stream)
+            text = stream.getvalue()
+
+        loaded = sc.ScanningStrategy()
+        loaded.load(text)
+        for key in sc.ScanningStrategy.__slots__:
+            self.assertEqual(getattr(loaded, key), getattr(scanning, key))
+
+    def test_single_file_tod_writer(self):
+        chunks = []
+        scanning = sc.ScanningStrategy(wheel3_rpm=1.0,
+                                       latitude_deg=28.3,
+                                       overall_time_s=10.0,
+                                       sampling_frequency_hz=5.0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_name = os.path.join(tmpdir, 'pointings.fits')
+            with sc.SingleFileTodWriter(file_name) as writer:
+                def callback(pointings, **kwargs):
+                    chunks.append(pointings)
+                    writer(pointings=pointings, **kwargs)
+
+                sc.generate_pointings(scanning=scanning, dir_vec=[0, 0, 1],
+                                      num_of_chunks=3, tod_callback=callback)
+
+            with fits.open(file_name) as f:
+                self.assertEqual(len(f), 4)
+                for index, pointings in enumerate(chunks):
+                    tod = f['TOD', index + 1]
+                    self.assertEqual(tod.header['TODIDX'], index)
+                    self.assertTrue(np.allclose(tod.data.field('PHI'),
+                                                pointings[:, 2]))
@@ -2,10 +2,13 @@
 # -*- encoding: utf-8 -*-
 
 import unittest as ut
+from unittest import mock
 import os.path
 
 import stripeline.timetools as tt
+import healpy
 import numpy as np
+from mpi4py import MPI
 
 
 class TestTimeTools(ut.TestCase):
@@ -139,5 +142,170 @@ class TestToiProviders(ut.TestCase):
         sig_from_idx = providers[0].get_signal(0)
         sig_from_name = providers[0].get_signal('Q1')
         self.assertTrue(np.allclose(sig_from_idx, sig_from_name))
+        self.assertTrue(np.array_equal(providers[0].get_signal(-1),
+                                       providers[0].get_signal('U2')))
+        all_signals = providers[0].get_all_signals()
+        self.assertEqual(len(all_signals), 4)
+        for det_idx in range(4):
+            self.assertTrue(np.array_equal(all_signals[det_idx],
+                                           providers[0].get_signal(det_idx)))
         self.assertTrue(np.allclose(
             sig_from_idx, np.array([0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9])))
+
+    def test_collective_io(self):
+        'Verify that FitsToiProvider can read a TOI using MPI collective calls'
+
+        comm = MPI.COMM_WORLD
+        test_file_path = os.path.dirname(__file__)
+        file_names = [os.path.join(test_file_path, x) for x in ['toi_test_A.fits',
+                                                                'toi_test_B.fits',
+                                                                'toi_test_C.fits']]
+        file_layout = \
+            tt.FitsTableLayout(time_col=tt.FitsColumn(hdu=1, column='TIME'),
+                               theta_col=tt.FitsColumn(hdu=2, column=0),
+                               phi_col=tt.FitsColumn(hdu=2, column=1),
+                               psi_col=tt.FitsColumn(hdu=2, column=2),
+                               signal_cols=[])
+
+        providers = [tt.FitsToiProvider(rank=comm.rank,
+                                        num_of_processes=comm.size,
+                                        file_names=file_names,
+                                        file_layout=file_layout,
+                                        comm=comm,
+                                        collective_io=collective_io)
+                     for collective_io in (False, True)]
+        self.assertTrue(np.array_equal(providers[0].get_time(),
+                                       providers[1].get_time()))
+        self.assertTrue(np.array_equal(providers[0].get_pixel_index(nside=4),
+                                       providers[1].get_pixel_index(nside=4)))
+
+    def test_pointings_cache(self):
+        'Verify that FitsToiProvider reads the pointings only once'
+
+        file_name = os.path.join(os.path.dirname(__file__), 'toi_test_B.fits')
+        file_layout = \
+            tt.FitsTableLayout(time_col=tt.FitsColumn(hdu=1, column='TIME'),
+                               theta_col=tt.FitsColumn(hdu=2, column=0),
+                               phi_col=tt.FitsColumn(hdu=2, column=1),
+                               psi_col=tt.FitsColumn(hdu=2, column=2),
+                               signal_cols=[])
+        provider = tt.FitsToiProvider(rank=0, num_of_processes=1,
+                                      file_names=[file_name],
+                                      file_layout=file_layout)
+
+        # If the pointings have not been loaded yet, get_pixel_index does not
+        # keep them in memory
+        pixidx = provider.get_pixel_index(nside=1)
+        self.assertIsNone(provider._pointings_cache)
+        self.assertEqual(pixidx.dtype, np.int32)
+
+        theta, phi = provider.get_pointings()
+        psi = provider.get_polarization_angle()
+        self.assertTrue(np.array_equal(pixidx, healpy.ang2pix(1, theta, phi)))
+        self.assertIs(provider.get_pointings()[0], theta)
+        self.assertIs(provider.get_polarization_angle(), psi)
+        cached_pixidx = provider.get_pixel_index(nside=1)
+        self.assertEqual(cached_pixidx.dtype, np.int32)
+        self.assertTrue(np.array_equal(cached_pixidx,
+                                       healpy.ang2pix(1, theta, phi)))
+
+        provider.release_cache()
+        new_theta, _ = provider.get_pointings()
+        self.assertIsNot(new_theta, theta)
+        self.assertTrue(np.array_equal(new_theta, theta))
+
+    def test_pixel_index_blocks(self):
+        'Verify that get_pixel_index reads the pointings in small blocks'
+
+        test_file_path = os.path.dirname(__file__)
+        file_names = [os.path.join(test_file_path, x) for x in ['toi_test_A.fits',
+                                                                'toi_test_B.fits',
+                                                                'toi_test_C.fits']]
+        file_layout = \
+            tt.FitsTableLayout(time_col=tt.FitsColumn(hdu=1, column='TIME'),
+                               theta_col=tt.FitsColumn(hdu=2, column=0),
+                               phi_col=tt.FitsColumn(hdu=2, column=1),
+                               psi_col=tt.FitsColumn(hdu=2, column=2),
+                               signal_cols=[])
+
+        for rank in range(2):
+            provider = tt.FitsToiProvider(rank=rank, num_of_processes=2,
+                                          file_names=file_names,
+                                          file_layout=file_layout)
+
+            # With blocks of 4 samples, some blocks span two files
+            with mock.patch.object(tt, '_PIXEL_INDEX_BLOCK_SIZE', 4), \
+                    mock.patch.object(tt, '_load_array_from_fits',
+                                      wraps=tt._load_array_from_fits) as load:
+                pixidx = provider.get_pixel_index(nside=4)
+                psi = provider.get_polarization_angle()
+
+            # Nothing is kept in memory, and psi is read on its own
+            self.assertIsNone(provider._pointings_cache)
+            *block_calls, psi_call = load.call_args_list
+            self.assertEqual(psi_call[1]['cols_to_read'], [file_layout.psi_col])
+
+            block_sizes = [sum(x.num_of_elements for x in call[1]['segments'])
+                           for call in block_calls]
+            self.assertTrue(all(x <= 4 for x in block_sizes))
+            self.assertEqual(sum(block_sizes), provider.samples_per_process[rank])
+            self.assertTrue(any(len(call[1]['segments']) > 1
+                                for call in block_calls))
+
+            theta, phi = provider.get_pointings()
+            self.assertTrue(np.array_equal(pixidx, healpy.ang2pix(4, theta, phi)))
+            self.assertTrue(np.array_equal(psi, provider.get_polarization_angle()))
+
+    def test_read_fits_files_information(self):
+        'Verify that headers read by many threads are kept in order'
+
+        test_file_path = os.path.dirname(__file__)
+        file_names = [os.path.join(test_file_path, x) for x in ['toi_test_C.fits',
+                                                                'toi_test_A.fits',
+                                                                'toi_test_B.fits']]
+        tt.clear_fits_info_cache()
+        serial = tt._read_fits_files_information(file_names, num_workers=1)
+        parallel = tt._read_fits_files_information(file_names, num_workers=3)
+        self.assertEqual(serial, parallel)
+        self.assertEqual([x.file_name for x in parallel], file_names)
+
+        # The headers are cached, unless the cache is cleared
+        self.assertGreater(tt._read_fits_file_information.cache_info().hits, 0)
+        tt.clear_fits_info_cache()
+        self.assertEqual(tt._read_fits_file_information.cache_info().currsize, 0)
+
+    def test_load_array_num_workers(self):
+        'Verify that segments read by many threads end up in the right place'
+
+        test_file_path = os.path.dirname(__file__)
+        segments = [tt.ToiFileSegment(file_name=os.path.join(test_file_path, name),
+                                      first_element=first,
+                                      num_of_elements=num)
+                    for name, first, num in (('toi_test_A.fits', 1, 3),
+                                             ('toi_test_B.fits', 0, 4),
+                                             ('toi_test_C.fits', 2, 2))]
+        cols_to_read = [tt.FitsColumn(hdu=1, column='TIME'),
+                        tt.FitsColumn(hdu=3, column='DET_Q1')]
+
+        serial = tt._load_array_from_fits(segments, cols_to_read, num_workers=1)
+        parallel = tt._load_array_from_fits(segments, cols_to_read, num_workers=3)
+        single = tt._load_array_from_fits(segments, cols_to_read, dtype=np.float32)
+        for expected, actual, actual32 in zip(serial, parallel, single):
+            self.assertEqual(len(actual), 9)
+            self.assertTrue(np.array_equal(expected, actual))
+            self.assertEqual(actual32.dtype, np.float32)
+            self.assertTrue(np.allclose(expected, actual32))
+
+    @ut.skipIf(tt.fitsio is None, 'fitsio is not installed')
+    def test_fitsio_backend(self):
+        'Verify that fitsio and astropy read the same data'
+
+        file_name = os.path.join(os.path.dirname(__file__), 'toi_test_B.fits')
+        cols_to_read = [tt.FitsColumn(hdu=1, column='TIME'),
+                        tt.FitsColumn(hdu=2, column=1),
+                        tt.FitsColumn(hdu=3, column='DET_Q1')]
+
+        expected, actual = np.empty((2, len(cols_to_read), 3))
+        tt._read_columns_astropy(file_name, cols_to_read, 1, expected)
+        tt._read_columns_fitsio(file_name, cols_to_read, 1, actual)
+        self.assertTrue(np.allclose(expected, actual))
@@ -1,4 +1,4 @@
-from stripeline.maptools import binned_map
+from stripeline.maptools import binned_map_detectors_ang
 from astropy.io import fits
 import healpy
 import click
@@ -13,18 +13,11 @@ def main(tod_filename, nside, map_filename):
     f = fits.open(tod_filename)
     theta, phi, detQ1, detQ2, detU1, detU2 = [f[1].data.field(
         x) for x in ('THETA', 'PHI', 'DETQ1', 'DETQ2', 'DETU1', 'DETU2')]
-    pixidx = healpy.ang2pix(nside, theta, phi)
-    num_of_pixels = healpy.nside2npix(nside)
-    Imap, hits = binned_map(detQ1 + detQ2 + detU1 +
-                            detU2, pixidx, num_of_pixels)
-    Qmap, hits = binned_map(2 * (detQ1 - detQ2), pixidx, num_of_pixels)
-    Umap, hits = binned_map(2 * (detU1 - detU2), pixidx, num_of_pixels)
+    Imap, Qmap, Umap, hits = binned_map_detectors_ang(detQ1, detQ2, detU1, detU2,
+                                                      theta, phi, nside)
 
     healpy.write_map(map_filename, (Imap, Qmap, Umap, hits))
 
 
 if __name__ == '__main__':
     main()
-
-
-f = fits.open('')